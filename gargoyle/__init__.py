@@ -6,7 +6,7 @@ gargoyle
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
-__all__ = ('gargoyle', 'ConditionSet', 'autodiscover', 'VERSION')
+__all__ = ('gargoyle', 'ConditionSet', 'autodiscover', 'warm', 'VERSION')
 
 try:
     VERSION = __import__('pkg_resources') \
@@ -37,6 +37,33 @@ def autodiscover():
             # this import will have to reoccur on the next request and this
             # could raise NotRegistered and AlreadyRegistered exceptions
             gargoyle._registry = before_import_registry
+            gargoyle._registry_changed()
 
     # load builtins
     __import__('gargoyle.builtins')
+
+
+def warm(manager=None):
+    """
+    Discovers condition sets (see ``autodiscover``), then loads and compiles
+    the switches of ``manager`` (``gargoyle`` by default), returning its
+    ``SwitchSnapshot``.
+
+    Calling this before forking workers (e.g. from an app preloaded by
+    gunicorn, or by uwsgi without ``lazy-apps``) saves each of them loading
+    the switches on their first request, and they share the memory the
+    switches take up until they change.
+    """
+    import gc
+
+    autodiscover()
+    if manager is None:
+        manager = gargoyle
+    snapshot = manager.warm()
+
+    # keep the collector from writing to (and so copying) the pages of what
+    # was loaded, where it's possible
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    return snapshot
@@ -0,0 +1,358 @@
+"""
+gargoyle.backends
+~~~~~~~~~~~~~~~~~
+
+Where ``SwitchManager`` loads switches from.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import json
+import os
+import time
+import uuid
+
+from django.core.cache import cache as default_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from gargoyle.chunked import FOREVER
+from gargoyle.compact import CompactSwitch
+from gargoyle.models import Switch, DeletedSwitch, DISABLED, SELECTIVE, GLOBAL, INHERIT
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+STATUSES = {
+    'disabled': DISABLED,
+    'selective': SELECTIVE,
+    'global': GLOBAL,
+    'inherit': INHERIT,
+}
+
+
+def get_backend(path, **kwargs):
+    """
+    Returns an instance of the backend class at ``path`` (e.g.
+    ``gargoyle.backends.FileBackend``), created with ``kwargs``.
+    """
+    module_name, _, class_name = path.rpartition('.')
+    try:
+        backend_class = getattr(import_module(module_name), class_name)
+    except (ImportError, AttributeError, ValueError), e:
+        raise ImproperlyConfigured('Unable to import switch backend %r: %s' % (path, e))
+    return backend_class(**kwargs)
+
+
+class SwitchBackend(object):
+    """
+    Loads switches, as ``CompactSwitch`` instances, for ``SwitchManager``.
+
+    ``cached`` backends have the switches they load published to the cache
+    of the manager, which polls a version it bumps whenever a ``Switch`` is
+    saved. Other backends are cheap enough to load from, and tell when their
+    switches change with ``get_version``.
+    """
+    cached = False
+    # whether ``load_modified`` is implemented (see ``GARGOYLE_INCREMENTAL_REFRESH``)
+    supports_incremental = False
+
+    def load(self):
+        """
+        Returns all switches by key, along with the latest time any of them
+        was modified (or ``None``).
+        """
+        raise NotImplementedError
+
+    def load_modified(self, since):
+        """
+        Returns the switches modified since ``since`` by key, the latest time
+        any of them was modified, and the time each switch deleted since then
+        was deleted by key.
+        """
+        raise NotImplementedError
+
+    def get_version(self):
+        """
+        Returns a value which changes whenever the switches do.
+        """
+        return None
+
+    def get(self, key):
+        """
+        Returns the switch for ``key``, or ``None``.
+        """
+        return self.load()[0].get(key)
+
+    def get_instance(self, key):
+        """
+        Returns the ``Switch`` instance for ``key`` (e.g. for Nexus), or
+        ``None``.
+        """
+        switch = self.get(key)
+        if switch is None:
+            return None
+        return Switch(key=switch.key, status=switch.status, value=switch.value)
+
+    def get_instances(self, keys):
+        """
+        Returns the ``Switch`` instances for ``keys`` by key, leaving out
+        those which don't exist.
+        """
+        instances = {}
+        for key in keys:
+            instance = self.get_instance(key)
+            if instance is not None:
+                instances[key] = instance
+        return instances
+
+    def create(self, key):
+        """
+        Creates the switch for ``key`` (see ``GARGOYLE_AUTO_CREATE``) and
+        returns it, or returns ``None`` if switches can't be created.
+        """
+        return None
+
+
+class ModelBackend(SwitchBackend):
+    """
+    Loads switches from the ``Switch`` model. This is the default.
+    """
+    cached = True
+    supports_incremental = True
+
+    def __init__(self, model=Switch, key='key', value='value'):
+        self.model = model
+        self.key = key
+        self.value = value
+
+    def _load(self, queryset):
+        to_python = self.model._meta.get_field(self.value).to_python
+        switches, watermark = {}, None
+        for key, status, value, date_modified in queryset.values_list(
+                self.key, 'status', self.value, 'date_modified'):
+            switches[key] = CompactSwitch(key, status, to_python(value))
+            if watermark is None or date_modified > watermark:
+                watermark = date_modified
+        return switches, watermark
+
+    def load(self):
+        return self._load(self.model._default_manager.all())
+
+    def load_modified(self, since):
+        switches, watermark = self._load(self.model._default_manager.filter(date_modified__gte=since))
+        tombstones = dict(DeletedSwitch.objects.filter(date_deleted__gte=since).values_list('key', 'date_deleted'))
+        return switches, watermark, tombstones
+
+    def get(self, key):
+        return self._load(self.model._default_manager.filter(**{self.key: key}))[0].get(key)
+
+    def get_instance(self, key):
+        try:
+            return self.model._default_manager.get(**{self.key: key})
+        except self.model.DoesNotExist:
+            return None
+
+    def get_instances(self, keys):
+        # all of them, rather than a query with as many parameters as keys
+        keys = set(keys)
+        return dict((getattr(instance, self.key), instance) for instance in self.model._default_manager.all()
+                    if getattr(instance, self.key) in keys)
+
+    def create(self, key):
+        return self.model._default_manager.get_or_create(**{self.key: key})[0]
+
+
+class MemoryBackend(SwitchBackend):
+    """
+    Holds switches in memory, e.g. for tests or scripts.
+
+    >>> backend = MemoryBackend([CompactSwitch('my_feature', GLOBAL, {})]) #doctest: +SKIP
+    """
+    def __init__(self, switches=()):
+        self._switches = dict((s.key, CompactSwitch(s.key, s.status, s.value)) for s in switches)
+        self._version = 0
+
+    def load(self):
+        return dict(self._switches), None
+
+    def get_version(self):
+        return self._version
+
+    def get(self, key):
+        return self._switches.get(key)
+
+    def create(self, key):
+        # with the status given by GARGOYLE_SWITCH_DEFAULTS
+        switch = Switch(key=key)
+        self.save(switch)
+        return self._switches[key]
+
+    def save(self, switch):
+        """
+        Adds or replaces ``switch`` (anything with a key, status and value).
+        """
+        self._switches[switch.key] = CompactSwitch(switch.key, switch.status, switch.value)
+        self._version += 1
+
+    def delete(self, key):
+        self._switches.pop(key, None)
+        self._version += 1
+
+
+class FileBackend(SwitchBackend):
+    """
+    Reads switches from a JSON file, or a YAML file if its name ends with
+    ``.yaml`` or ``.yml`` (which requires PyYAML), mapping keys to statuses
+    and conditions:
+
+        {
+            "my_feature": {"status": "global"},
+            "my_other_feature": {
+                "status": "selective",
+                "value": {"auth.user": {"is_staff": [["i", "1"]]}}
+            }
+        }
+
+    The file is read again whenever it's modified.
+    """
+    def __init__(self, path):
+        self.path = path
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ImproperlyConfigured('PyYAML is required to read switches from %s' % (path,))
+            self._parse = yaml.safe_load
+        else:
+            self._parse = json.load
+
+    def load(self):
+        with open(self.path) as fp:
+            data = self._parse(fp) or {}
+        switches = {}
+        for key, switch in data.iteritems():
+            status = switch.get('status', DISABLED)
+            status = STATUSES.get(status, status)
+            if status not in STATUSES.values():
+                raise ValueError('Invalid status %r for switch %r in %s' % (status, key, self.path))
+            switches[key] = CompactSwitch(key, status, switch.get('value') or {})
+        return switches, None
+
+    def get_version(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime, stat.st_size
+
+
+class CacheBackend(SwitchBackend):
+    """
+    Stores each switch under its own key in a Django cache, so a single
+    switch can be read (see ``get``) without loading the others.
+
+    The keys of all switches are kept under ``<key_prefix>.switches``, and a
+    version bumped whenever a switch is saved or deleted under
+    ``<key_prefix>.switches.version``. Use ``save`` and ``delete`` (e.g.
+    from the ``Switch`` model signals) to keep them up to date. The list of
+    keys is only changed while holding a lock (``<key_prefix>.switches.lock``,
+    taken with ``add``), so concurrent saves don't lose each other's keys.
+
+    They are stored for ``timeout`` seconds, or forever by default (see
+    ``gargoyle.chunked.FOREVER``). The cache must not evict them: should the
+    list of keys be evicted, all switches would be lost. ``load`` raises ``RuntimeError`` rather than return no
+    switches when the list is gone but the version isn't, so the switches
+    already loaded keep being used until ``save_many`` stores them again.
+    """
+    # how long the lock on the list of keys is held at most
+    lock_timeout = 5
+    lock_poll_interval = 0.01
+
+    def __init__(self, cache=None, key_prefix='gargoyle', timeout=FOREVER):
+        self.cache = cache or default_cache
+        self.key_prefix = key_prefix
+        self.timeout = timeout
+        self.keys_key = '%s.switches' % (key_prefix,)
+        self.version_key = '%s.switches.version' % (key_prefix,)
+        self.lock_key = '%s.switches.lock' % (key_prefix,)
+
+    def get_key(self, key):
+        return '%s.switch:%s' % (self.key_prefix, key)
+
+    def _set_many(self, data):
+        self.cache.set_many(data, timeout=self.timeout)
+
+    def _get_keys(self):
+        keys = self.cache.get(self.keys_key)
+        if keys is None and self.cache.get(self.version_key) is not None:
+            raise RuntimeError('The list of switches under %r was evicted, use save_many to store them again'
+                               % (self.keys_key,))
+        return keys or []
+
+    def _update_keys(self, update, replace=False):
+        """
+        Calls ``update`` with the set of keys of all switches (empty if
+        ``replace``), and stores it, holding the lock on it.
+        """
+        token = uuid.uuid4().hex
+        # anyone holding the lock longer than lock_timeout has lost it
+        deadline = time.time() + self.lock_timeout * 2
+        while not self.cache.add(self.lock_key, token, self.lock_timeout):
+            if time.time() > deadline:
+                raise RuntimeError('Unable to lock the list of switches under %r' % (self.keys_key,))
+            time.sleep(self.lock_poll_interval)
+        try:
+            keys = set() if replace else set(self._get_keys())
+            update(keys)
+            self._set_many({self.keys_key: sorted(keys)})
+        finally:
+            # unless it expired and was taken by another writer
+            if self.cache.get(self.lock_key) == token:
+                self.cache.delete(self.lock_key)
+
+    def load(self):
+        keys = self._get_keys()
+        stored = self.cache.get_many([self.get_key(k) for k in keys])
+        switches = {}
+        for key in keys:
+            data = stored.get(self.get_key(key))
+            if data is not None:
+                switches[key] = CompactSwitch(key, *data)
+        return switches, None
+
+    def get_version(self):
+        return self.cache.get(self.version_key)
+
+    def get(self, key):
+        data = self.cache.get(self.get_key(key))
+        if data is None:
+            return None
+        return CompactSwitch(key, *data)
+
+    def save(self, switch):
+        """
+        Adds or replaces ``switch`` (anything with a key, status and value).
+        """
+        self._set_many({self.get_key(switch.key): (switch.status, switch.value)})
+        self._update_keys(lambda keys: keys.add(switch.key))
+        self._bump_version()
+
+    def save_many(self, switches):
+        """
+        Replaces all switches with ``switches``.
+        """
+        switches = list(switches)
+        self._set_many(dict((self.get_key(s.key), (s.status, s.value)) for s in switches))
+        self._update_keys(lambda keys: keys.update(s.key for s in switches), replace=True)
+        self._bump_version()
+
+    def delete(self, key):
+        self._update_keys(lambda keys: keys.discard(key))
+        self.cache.delete(self.get_key(key))
+        self._bump_version()
+
+    def _bump_version(self):
+        try:
+            self.cache.incr(self.version_key)
+        except ValueError:
+            # not set, or evicted (see ``SwitchManager._init_version``)
+            self.cache.add(self.version_key, int(time.time() * 1000) << 20, timeout=self.timeout)
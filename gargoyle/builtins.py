@@ -8,11 +8,13 @@ gargoyle.builtins
 
 from gargoyle import gargoyle
 from gargoyle.conditions import ModelConditionSet, RequestConditionSet, Percent, String, Boolean, \
-    ConditionSet, OnOrAfterDate
+    EnvironmentConditionSet, OnOrAfterDate, ConditionMatcher
+from gargoyle.models import EXCLUDE
+from gargoyle.networks import PrefixSet, parse_ip, parse_network
 
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
-from django.core.validators import validate_ipv4_address
+from django.core.validators import validate_ipv4_address, ValidationError
 
 import socket
 import struct
@@ -43,13 +45,16 @@ class UserConditionSet(ModelConditionSet):
         value is the current value of the switch
         instance is the instance of our type
         """
+        # also keeps the ``is_active`` field above out of ``fields``
+        return self.is_active_compiled(instance, self.compile(conditions) or {})
+
+    def is_active_compiled(self, instance, compiled, values=None):
         if isinstance(instance, User):
-            return super(UserConditionSet, self).is_active(instance, conditions)
+            return super(UserConditionSet, self).is_active_compiled(instance, compiled, values)
 
         # HACK: allow is_authenticated to work on AnonymousUser
-        condition = conditions.get(self.get_namespace(), {}).get('is_anonymous')
-        if condition is not None:
-            return bool(condition)
+        if 'is_anonymous' in compiled:
+            return True
         return None
 
 gargoyle.register(UserConditionSet(User))
@@ -61,11 +66,66 @@ class IPAddress(String):
         return value
 
 
+class NetworkMatcher(object):
+    """
+    A ``ConditionMatcher`` for ``IPNetwork`` conditions, which looks addresses
+    up in ``PrefixSet`` indexes of the included and excluded networks.
+    """
+    def __init__(self, includes, excludes):
+        self.includes = includes
+        self.excludes = excludes
+
+    def __call__(self, value):
+        if value is not None and value in self.excludes:
+            return False
+        elif self.excludes:
+            return True
+        elif value is not None and value in self.includes:
+            return True
+        return None
+
+
+class IPNetwork(String):
+    """
+    Matches IPv4 and IPv6 addresses against networks in CIDR notation
+    (e.g. ``10.0.0.0/8``). The value is an address as returned by
+    ``parse_ip``, or ``None``.
+    """
+    default_help_text = 'e.g. 10.0.0.0/8 or 2001:db8::/32'
+
+    def clean(self, value):
+        try:
+            parse_network(value)
+        except ValueError:
+            raise ValidationError('Enter a valid IPv4 or IPv6 network.')
+        return value
+
+    def is_active(self, condition, value):
+        return value is not None and value in PrefixSet([condition])
+
+    def compile(self, conditions):
+        includes, excludes = PrefixSet(), PrefixSet()
+        try:
+            for status, condition in conditions:
+                if status == EXCLUDE:
+                    excludes.add(condition)
+                else:
+                    includes.add(condition)
+        except ValueError:
+            # fail when checked, rather than when loaded
+            return ConditionMatcher(self, conditions)
+        return NetworkMatcher(includes, excludes)
+
+
 class IPAddressConditionSet(RequestConditionSet):
     percent = Percent()
     ip_address = IPAddress(label='IP Address')
+    ip_network = IPNetwork(label='IP Network')
     internal_ip = Boolean(label='Internal IPs')
 
+    # (settings.INTERNAL_IPS, PrefixSet of it or None)
+    _internal_ips = (None, None)
+
     def get_namespace(self):
         return 'ip'
 
@@ -76,10 +136,45 @@ class IPAddressConditionSet(RequestConditionSet):
             return self._ip_to_int(instance.META['REMOTE_ADDR'])
         elif field_name == 'ip_address':
             return instance.META['REMOTE_ADDR']
+        elif field_name == 'ip_network':
+            try:
+                return parse_ip(instance.META['REMOTE_ADDR'])
+            except ValueError:
+                return None
         elif field_name == 'internal_ip':
-            return instance.META['REMOTE_ADDR'] in settings.INTERNAL_IPS
+            return self._is_internal_ip(instance.META['REMOTE_ADDR'])
         return super(IPAddressConditionSet, self).get_field_value(instance, field_name)
 
+    def _get_internal_ips(self):
+        """
+        Returns a ``PrefixSet`` of ``settings.INTERNAL_IPS``, which may also
+        contain networks, or ``None`` if it can't be indexed.
+
+        Only plain lists, tuples and sets are indexed, as subclasses (or
+        other containers) may define their own ``__contains__``.
+        """
+        internal_ips = settings.INTERNAL_IPS
+        source, networks = self._internal_ips
+        if source is not internal_ips:
+            networks = None
+            if type(internal_ips) in (list, tuple, set, frozenset):
+                try:
+                    networks = PrefixSet(internal_ips)
+                except ValueError:
+                    pass
+            # rebuilt whenever the setting is replaced
+            self._internal_ips = (internal_ips, networks)
+        return networks
+
+    def _is_internal_ip(self, ip):
+        networks = self._get_internal_ips()
+        if networks is None:
+            return ip in settings.INTERNAL_IPS
+        try:
+            return parse_ip(ip) in networks
+        except ValueError:
+            return False
+
     def _ip_to_int(self, ip):
         if '.' in ip:
             # IPv4
@@ -96,15 +191,12 @@ class IPAddressConditionSet(RequestConditionSet):
 gargoyle.register(IPAddressConditionSet())
 
 
-class HostConditionSet(ConditionSet):
+class HostConditionSet(EnvironmentConditionSet):
     hostname = String()
 
     def get_namespace(self):
         return 'host'
 
-    def can_execute(self, instance):
-        return instance is None
-
     def get_field_value(self, instance, field_name):
         if field_name == 'hostname':
             return socket.gethostname()
@@ -0,0 +1,99 @@
+"""
+gargoyle.chunked
+~~~~~~~~~~~~~~~~
+
+Stores values too large for a single cache entry (memcached refuses items
+over 1MB) as compressed chunks, listed by a manifest.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import cPickle as pickle
+import hashlib
+import zlib
+
+import django
+
+FORMAT = 1
+
+DEFAULT_CHUNK_SIZE = 512 * 1024
+
+# the timeout keeping cache entries the longest. ``None`` only means forever
+# since Django 1.6, before which memcached is given at most 30 days.
+if django.VERSION >= (1, 6):
+    FOREVER = None
+else:
+    FOREVER = 60 * 60 * 24 * 30
+
+_default_timeout = object()
+
+
+def get_chunk_keys(key, manifest):
+    return ['%s:%s:%d' % (key, manifest['checksum'], i) for i in xrange(manifest['chunks'])]
+
+
+def set_chunked(cache, key, value, chunk_size=DEFAULT_CHUNK_SIZE, timeout=_default_timeout, tag=None):
+    """
+    Stores ``value`` under ``key`` in ``cache``, pickled and compressed, as
+    chunks of at most ``chunk_size`` bytes, for ``timeout`` seconds (see
+    ``FOREVER``), or the default timeout of ``cache``.
+
+    ``tag`` (such as a version) is kept in the manifest, so readers can tell
+    whether they want the value before fetching its chunks.
+
+    The chunks are stored first, under keys which include the checksum of the
+    whole, and then the manifest under ``key``, so readers never see a mix of
+    chunks from different values. The chunks of the value it replaces are
+    then deleted.
+    """
+    old_manifest = cache.get(key)
+    data = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    manifest = {
+        'format': FORMAT,
+        'tag': tag,
+        'checksum': hashlib.sha1(data).hexdigest(),
+        'length': len(data),
+        'chunks': max(1, (len(data) + chunk_size - 1) // chunk_size),
+    }
+    chunks = dict(
+        (chunk_key, data[i * chunk_size:(i + 1) * chunk_size])
+        for i, chunk_key in enumerate(get_chunk_keys(key, manifest))
+    )
+    kwargs = {} if timeout is _default_timeout else {'timeout': timeout}
+    cache.set_many(chunks, **kwargs)
+    cache.set(key, manifest, **kwargs)
+
+    if _is_manifest(old_manifest) and old_manifest['checksum'] != manifest['checksum']:
+        cache.delete_many(get_chunk_keys(key, old_manifest))
+
+
+def _is_manifest(manifest):
+    return isinstance(manifest, dict) and manifest.get('format') == FORMAT
+
+
+def get_chunked(cache, key, tag=None):
+    """
+    Returns the value stored under ``key`` by ``set_chunked``, fetching all
+    of its chunks at once.
+
+    Returns ``None`` if there is no value, if it is incomplete or corrupt, or
+    if it wasn't stored with ``tag``.
+    """
+    manifest = cache.get(key)
+    if not _is_manifest(manifest) or manifest.get('tag') != tag:
+        return None
+
+    chunk_keys = get_chunk_keys(key, manifest)
+    chunks = cache.get_many(chunk_keys)
+    if len(chunks) != len(chunk_keys):
+        # some were evicted
+        return None
+
+    data = ''.join(chunks[chunk_key] for chunk_key in chunk_keys)
+    if len(data) != manifest['length'] or hashlib.sha1(data).hexdigest() != manifest['checksum']:
+        return None
+    try:
+        return pickle.loads(zlib.decompress(data))
+    except Exception:
+        return None
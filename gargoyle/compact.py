@@ -0,0 +1,111 @@
+"""
+gargoyle.compact
+~~~~~~~~~~~~~~~~
+
+A compact form of switches, holding only what checking them needs.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import cPickle as pickle
+import zlib
+
+from gargoyle.shared import read_file, write_file
+
+# bumped whenever the layout of ``dump`` changes
+SCHEMA = 1
+
+
+class CompactSwitch(object):
+    """
+    The key, status and (parsed) conditions of a switch, which is all that's
+    needed to check it, without its labels, dates or model state.
+
+    ``SwitchManager`` holds these, and only loads full ``Switch`` instances
+    when they're looked up, e.g. by Nexus.
+    """
+    __slots__ = ('key', 'status', 'value')
+
+    def __init__(self, key, status, value):
+        self.key = key
+        self.status = status
+        self.value = value
+
+    def __repr__(self):
+        return '<%s: %s=%r (%s)>' % (self.__class__.__name__, self.key, self.value, self.status)
+
+
+def dump(switches, watermark=None):
+    """
+    Returns ``switches`` (a dict of switches by key) as plain data, along with
+    ``watermark`` (the latest time any of them was modified).
+
+    Only built-in types are used, so the result can be read by any version of
+    gargoyle which knows its ``SCHEMA``.
+    """
+    return {
+        'schema': SCHEMA,
+        'watermark': watermark,
+        'switches': [(s.key, s.status, s.value) for s in switches.itervalues()],
+    }
+
+
+def load(data):
+    """
+    Returns ``(switches, watermark)`` from the result of ``dump``, with the
+    switches as ``CompactSwitch`` instances by key.
+
+    Returns ``None`` if ``data`` isn't of the current ``SCHEMA``.
+    """
+    if not isinstance(data, dict) or data.get('schema') != SCHEMA:
+        return None
+    switches = dict((key, CompactSwitch(key, status, value)) for key, status, value in data['switches'])
+    return switches, data['watermark']
+
+
+def dumps(switches, watermark=None, version=None):
+    """
+    Returns ``switches`` (see ``dump``) and their ``version`` as a compressed
+    string.
+    """
+    return zlib.compress(pickle.dumps({'version': version, 'data': dump(switches, watermark)},
+                                      pickle.HIGHEST_PROTOCOL))
+
+
+def loads(data):
+    """
+    Returns ``(switches, watermark, version)`` from the result of ``dumps``.
+
+    Returns ``None`` if ``data`` can't be read, or isn't of the current
+    ``SCHEMA``.
+    """
+    try:
+        data = pickle.loads(zlib.decompress(data))
+        loaded = load(data['data'])
+    except Exception:
+        return None
+    if loaded is None:
+        return None
+    return loaded + (data['version'],)
+
+
+def write(path, switches, watermark=None, version=None):
+    """
+    Writes ``switches`` and their ``version`` (see ``dumps``) to the file at
+    ``path``, atomically, so readers never see a partial file.
+    """
+    write_file(path, dumps(switches, watermark, version))
+
+
+def read(path):
+    """
+    Returns ``(switches, watermark, version)`` from the file written by
+    ``write`` at ``path``.
+
+    Returns ``None`` if there is no such file, or it can't be read.
+    """
+    data = read_file(path)
+    if data is None:
+        return None
+    return loads(data)
@@ -0,0 +1,478 @@
+"""
+gargoyle.compiler
+~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import itertools
+
+from django.http import HttpRequest
+
+from gargoyle.conditions import ConditionSet, EnvironmentConditionSet, ModelConditionSet, RequestConditionSet
+from gargoyle.models import DISABLED, SELECTIVE, GLOBAL, INHERIT
+
+
+def _overrides(condition_set, name):
+    return getattr(type(condition_set), name).im_func is not getattr(ConditionSet, name).im_func
+
+
+def _overrides_raw(condition_set, name, compiled_name):
+    # whether ``name`` is defined further down the MRO than ``compiled_name``
+    mro = type(condition_set).__mro__
+    defined = [i for i, cls in enumerate(mro) if name in cls.__dict__]
+    compiled = [i for i, cls in enumerate(mro) if compiled_name in cls.__dict__]
+    return bool(defined) and (not compiled or defined[0] < compiled[0])
+
+
+def uses_compiled_conditions(condition_set):
+    """
+    Returns ``True`` if ``condition_set`` can be evaluated against the
+    output of ``ConditionSet.compile``.
+
+    ConditionSets which override ``is_active`` or ``has_active_condition``
+    below the class providing their compiled equivalents (e.g. subclasses of
+    ``UserConditionSet``) are evaluated against the raw switch conditions,
+    exactly as they were before plans existed.
+    """
+    if _overrides_raw(condition_set, 'is_active', 'is_active_compiled'):
+        return False
+    if _overrides_raw(condition_set, 'has_active_condition', 'has_active_compiled'):
+        return False
+    return True
+
+
+def get_user_model():
+    try:
+        from django.contrib.auth import get_user_model
+    except ImportError:  # django < 1.5
+        from django.contrib.auth.models import User
+        return User
+    return get_user_model()
+
+
+def may_use_request_user(condition_set):
+    """
+    Returns ``False`` if ``condition_set`` can't act on the user of a request,
+    in which case checking it doesn't require loading ``request.user``.
+    """
+    can_execute = type(condition_set).can_execute.im_func
+    if can_execute in (RequestConditionSet.can_execute.im_func, EnvironmentConditionSet.can_execute.im_func):
+        return False
+    elif can_execute is ModelConditionSet.can_execute.im_func:
+        return issubclass(get_user_model(), condition_set.model)
+    return True
+
+
+def is_environment_scoped(condition_set):
+    """
+    Returns ``True`` if ``condition_set`` only acts on the environment of the
+    process (see ``EnvironmentConditionSet``), in which case its conditions
+    can be checked once, when a switch is compiled.
+    """
+    return type(condition_set).can_execute.im_func is EnvironmentConditionSet.can_execute.im_func
+
+
+def is_dispatchable(condition_set):
+    """
+    Returns ``True`` if ``condition_set`` can be checked against only the
+    instances it can execute on (see ``ConditionSetIndex.get_condition_sets_for``),
+    rather than through ``has_active_compiled``.
+    """
+    return uses_compiled_conditions(condition_set) and not _overrides(condition_set, 'has_active_compiled')
+
+
+def is_type_based(condition_set):
+    """
+    Returns ``True`` if whether ``condition_set`` can execute on an instance
+    only depends on the instance's class.
+    """
+    return type(condition_set).can_execute.im_func in _type_based_can_execute
+
+
+_type_based_can_execute = frozenset([
+    ConditionSet.can_execute.im_func,
+    ModelConditionSet.can_execute.im_func,
+    RequestConditionSet.can_execute.im_func,
+    EnvironmentConditionSet.can_execute.im_func,
+])
+
+
+def has_active_instances(condition_set, compiled, instances, values=None):
+    """
+    Same as ``ConditionSet.has_active_compiled``, for ``instances`` which are
+    known to be executable by ``condition_set`` (including ``None``).
+    """
+    return_value = None
+    for instance in instances:
+        result = condition_set.is_active_compiled(instance, compiled, values)
+        if result is False:
+            return False
+        elif result is True:
+            return_value = True
+    return return_value
+
+
+def _raw_condition_checker(condition_set):
+    def has_active(conditions, instances, values=None):
+        return condition_set.has_active_condition(conditions, instances)
+    return has_active
+
+
+class ConditionSetIndex(object):
+    """
+    An index of registered ConditionSets by namespace, so a switch only
+    needs to consider the ConditionSets it actually has conditions for.
+
+    ConditionSets which are evaluated against the raw conditions (see
+    ``uses_compiled_conditions``) may act on any namespace, so they are
+    always considered.
+
+    It also maps classes of instances to the ConditionSets which can execute
+    on them, so checking a switch doesn't require asking every ConditionSet
+    about every instance.
+    """
+    def __init__(self, condition_sets=()):
+        self.namespaces = {}
+        self.legacy = []
+        self._type_based = []
+        self._instance_based = []
+        # class -> ConditionSets which can execute on its instances
+        self._dispatch = {}
+        for condition_set in condition_sets:
+            if uses_compiled_conditions(condition_set):
+                self.namespaces.setdefault(condition_set.get_namespace(), []).append(condition_set)
+            else:
+                self.legacy.append(condition_set)
+            if is_dispatchable(condition_set):
+                if is_type_based(condition_set):
+                    self._type_based.append(condition_set)
+                else:
+                    self._instance_based.append(condition_set)
+
+    def get_condition_sets(self, conditions):
+        """
+        Returns the ConditionSets with a namespace in ``conditions``.
+        """
+        namespaces = self.namespaces
+        for namespace in conditions:
+            for condition_set in namespaces.get(namespace, ()):
+                yield condition_set
+
+    def get_condition_sets_for(self, instance):
+        """
+        Returns the dispatchable ConditionSets (see ``is_dispatchable``) which
+        can execute on ``instance``.
+        """
+        cls = instance.__class__
+        try:
+            condition_sets = self._dispatch[cls]
+        except KeyError:
+            condition_sets = self._dispatch[cls] = tuple(
+                c for c in self._type_based if c.can_execute(instance))
+        if self._instance_based:
+            condition_sets += tuple(c for c in self._instance_based if c.can_execute(instance))
+        return condition_sets
+
+
+class SwitchPlan(object):
+    """
+    The compiled form of a ``Switch``.
+
+    ``conditions`` is a list of ``(has_active, compiled, condition_set)``
+    tuples, one for each registered ConditionSet which has conditions on the
+    switch, where ``has_active(compiled, instances, values)`` gives that
+    ConditionSet's verdict. ``has_active`` is ``None`` for dispatchable
+    ConditionSets, which are only checked against the instances they can
+    execute on (see ``Evaluation.get_instances_for``). ``uses_user`` is
+    ``True`` if any of those ConditionSets may act on the user of a request.
+    ``matched`` is ``True`` if a condition already matched when the switch
+    was compiled.
+
+    Once linked to its parents (see ``link_plans``), ``ancestors`` holds the
+    plans of the selective parents which must also be active, root first.
+    When the result doesn't depend on any conditions, ``dynamic`` is
+    ``False`` and ``constant`` is the result (``None`` meaning the default
+    passed to ``is_active``).
+    """
+    __slots__ = ('key', 'status', 'conditions', 'uses_user', 'matched', 'ancestors', 'inherited', 'dynamic',
+                 'constant')
+
+    def __init__(self, key, status, conditions, uses_user=True, matched=False):
+        self.key = key
+        self.status = status
+        self.conditions = conditions
+        self.uses_user = uses_user
+        self.matched = matched
+        self.link(())
+
+    def __repr__(self):
+        return '<%s: %s (%s)>' % (self.__class__.__name__, self.key, self.status)
+
+    def link(self, parents):
+        """
+        Resolves the state this switch inherits from ``parents``, the plans
+        of its existing parents, root first.
+        """
+        ancestors = []
+        # a parent's conditions only decide the default if they all pass,
+        # in which case a global or selective parent makes it ``True``
+        inherited = None
+        for parent in parents:
+            if parent.status == DISABLED:
+                self.ancestors, self.inherited = (), None
+                self.dynamic, self.constant = False, False
+                return
+            elif parent.status == GLOBAL:
+                inherited = True
+            elif parent.status == SELECTIVE:
+                ancestors.append(parent)
+                inherited = True
+
+        self.ancestors = tuple(ancestors)
+        self.inherited = inherited
+
+        if self.status == DISABLED:
+            self.dynamic, self.constant = False, False
+        elif ancestors or self.status == SELECTIVE:
+            self.dynamic, self.constant = True, None
+        elif self.status == GLOBAL:
+            self.dynamic, self.constant = False, True
+        else:
+            self.dynamic, self.constant = False, inherited
+
+    def is_active(self, evaluation):
+        """
+        Returns ``True`` if any of the instances of ``evaluation`` match the
+        compiled conditions, unless one of them is explicitly excluded.
+        """
+        return_value = self.matched
+        uses_user = self.uses_user
+        values = evaluation.values
+        for has_active, compiled, condition_set in self.conditions:
+            if has_active is None:
+                instances = evaluation.get_instances_for(condition_set, uses_user)
+                result = has_active_instances(condition_set, compiled, instances, values)
+            else:
+                result = has_active(compiled, evaluation.get_instances(uses_user), values)
+            if result is False:
+                return False
+            elif result is True:
+                return_value = True
+        return return_value
+
+    def check(self, evaluation, default=False):
+        """
+        Returns the state of the switch, including its parents, for the
+        instances of ``evaluation``.
+        """
+        if not self.dynamic:
+            if self.constant is None:
+                return default
+            return self.constant
+
+        for ancestor in self.ancestors:
+            if not evaluation.is_active(ancestor):
+                return False
+
+        if self.status == SELECTIVE:
+            return evaluation.is_active(self)
+        elif self.status == GLOBAL or self.inherited:
+            return True
+        return default
+
+
+class Evaluation(object):
+    """
+    State shared by every check made against the same instances.
+
+    ``values`` caches the field values looked up by ConditionSets (see
+    ``ConditionSet.has_active_compiled``), and may be shared with other
+    evaluations. ``results`` caches the result of each selective switch's
+    conditions, by key. ``index`` is the ``ConditionSetIndex`` the plans being
+    checked were compiled with.
+    """
+    __slots__ = ('instances', 'values', 'results', 'index', '_expanded', '_dispatched')
+
+    def __init__(self, instances, values=None, index=None):
+        self.instances = instances
+        self.values = {} if values is None else values
+        self.results = {}
+        self.index = index
+        self._expanded = None
+        self._dispatched = {}
+
+    def get_instances(self, with_user=True):
+        """
+        Returns the instances to check conditions against.
+
+        Unless ``with_user`` is ``False``, this includes the user of any
+        request, which may require loading it.
+        """
+        if not with_user:
+            return self.instances
+        if self._expanded is None:
+            instances = list(self.instances)
+            # HACK: support request.user by swapping in User instance
+            for v in self.instances:
+                if isinstance(v, HttpRequest) and hasattr(v, 'user'):
+                    instances.append(v.user)
+            self._expanded = instances
+        return self._expanded
+
+    def is_active(self, plan):
+        """
+        Returns the result of ``plan``'s own conditions.
+        """
+        try:
+            return self.results[plan.key]
+        except KeyError:
+            result = self.results[plan.key] = plan.is_active(self)
+            return result
+
+    def get_instances_for(self, condition_set, with_user=True):
+        """
+        Returns the instances (see ``get_instances``), and ``None``, which
+        ``condition_set`` can execute on.
+        """
+        instances = itertools.chain(self.get_instances(with_user), [None])
+        if self.index is None:
+            return [i for i in instances if condition_set.can_execute(i)]
+        try:
+            dispatched = self._dispatched[with_user]
+        except KeyError:
+            dispatched = self._dispatched[with_user] = {}
+            for instance in instances:
+                for c in self.index.get_condition_sets_for(instance):
+                    dispatched.setdefault(c, []).append(instance)
+        return dispatched.get(condition_set, ())
+
+
+def get_parents(key, plans):
+    """
+    Returns the plans of the existing parents of ``key``, root first.
+    """
+    parents = []
+    parts = key.split(':')
+    for i in xrange(1, len(parts)):
+        parent = plans.get(':'.join(parts[:i]))
+        if parent is not None:
+            parents.append(parent)
+    return parents
+
+
+def link_plans(plans):
+    """
+    Links every plan in ``plans`` (a dictionary of plans by key) to its
+    parents, so checking a switch doesn't require walking its parents.
+    """
+    for key, plan in plans.iteritems():
+        if ':' in key:
+            plan.link(get_parents(key, plans))
+
+
+def compile_switch(switch, index):
+    """
+    Compiles ``switch`` against the registered ConditionSets in ``index`` (a
+    ``ConditionSetIndex``), returning a ``SwitchPlan``.
+
+    A selective switch without any conditions inherits from its parents, so
+    it is compiled with the ``INHERIT`` status. Conditions in environment
+    ConditionSets are checked right away, and a selective switch which has
+    no other conditions left is compiled as ``GLOBAL`` if they matched, or
+    ``DISABLED`` otherwise.
+    """
+    conditions = []
+    uses_user = False
+    matched = False
+    value = switch.value
+    status = switch.status
+
+    if status == SELECTIVE:
+        if not value:
+            status = INHERIT
+        else:
+            for condition_set in index.get_condition_sets(value):
+                compiled = condition_set.compile(value)
+                if compiled is None:
+                    continue
+                if is_environment_scoped(condition_set):
+                    result = condition_set.has_active_compiled(compiled, ())
+                    if result is False:
+                        return SwitchPlan(switch.key, DISABLED, [], False)
+                    matched = matched or result is True
+                elif is_dispatchable(condition_set):
+                    conditions.append((None, compiled, condition_set))
+                    uses_user = uses_user or may_use_request_user(condition_set)
+                else:
+                    conditions.append((condition_set.has_active_compiled, compiled, condition_set))
+                    uses_user = uses_user or may_use_request_user(condition_set)
+            for condition_set in index.legacy:
+                conditions.append((_raw_condition_checker(condition_set), value, condition_set))
+                uses_user = uses_user or may_use_request_user(condition_set)
+            if not conditions:
+                status = GLOBAL if matched else DISABLED
+
+    return SwitchPlan(switch.key, status, conditions, uses_user, matched)
+
+
+class SwitchSnapshot(object):
+    """
+    The switches as loaded at one point in time, along with the
+    ``ConditionSetIndex`` and the plans compiled from them.
+
+    A snapshot is never modified once created. When the switches (or the
+    registered ConditionSets) change, the manager builds a new one and
+    replaces its reference to the old one, so anything holding a snapshot
+    keeps seeing a consistent state without any locking.
+
+    ``constants`` maps the keys whose state doesn't depend on any instances
+    to that state (``None`` meaning the default passed to ``is_active``).
+    """
+    __slots__ = ('data', 'index', 'plans', 'constants')
+
+    def __init__(self, data, index, plans=None):
+        if plans is None:
+            plans = {}
+            if data:
+                plans = dict((k, compile_switch(v, index)) for k, v in data.iteritems())
+                link_plans(plans)
+        constants = dict((k, p.constant) for k, p in plans.iteritems() if not p.dynamic)
+        for name, value in (('data', data), ('index', index), ('plans', plans), ('constants', constants)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % (self.__class__.__name__,))
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is immutable' % (self.__class__.__name__,))
+
+    def __repr__(self):
+        return '<%s: %d switches>' % (self.__class__.__name__, len(self.plans))
+
+    def patch(self, data, keys):
+        """
+        Returns a snapshot of ``data``, which only differs from the data of this
+        snapshot for ``keys`` (changed, added or removed switches).
+
+        Only the plans of those switches, and of their children, are compiled
+        again. The others are shared with this snapshot.
+        """
+        plans = dict(self.plans)
+        affected = set()
+        for key in keys:
+            plans.pop(key, None)
+            affected.add(key)
+            prefix = key + ':'
+            affected.update(k for k in data if k.startswith(prefix))
+
+        compiled = []
+        for key in affected:
+            if key in data:
+                plan = plans[key] = compile_switch(data[key], self.index)
+                compiled.append(plan)
+        for plan in compiled:
+            if ':' in plan.key:
+                plan.link(get_parents(plan.key, plans))
+        return SwitchSnapshot(data, self.index, plans)
@@ -25,6 +25,32 @@ def titlize(s):
     return s.title().replace('_', ' ')
 
 
+class ConditionMatcher(object):
+    """
+    The compiled form of the ``(status, condition)`` pairs stored for a
+    single field of a switch.
+
+    Calling the matcher with a value returns ``False`` if an exclusion
+    matches, ``True`` if an inclusion matches (or an exclusion does not),
+    and ``None`` otherwise.
+    """
+    def __init__(self, field, conditions):
+        self.field = field
+        self.conditions = [(status == EXCLUDE, condition) for status, condition in conditions]
+
+    def __call__(self, value):
+        return_value = None
+        is_active = self.field.is_active
+        for exclude, condition in self.conditions:
+            if is_active(condition, value):
+                if exclude:
+                    return False
+                return_value = True
+            elif exclude:
+                return_value = True
+        return return_value
+
+
 class Field(object):
     default_help_text = None
 
@@ -41,6 +67,15 @@ class Field(object):
     def is_active(self, condition, value):
         return condition == value
 
+    def compile(self, conditions):
+        """
+        Given the list of ``(status, condition)`` pairs stored for this field,
+        returns a callable which checks a value against all of them at once.
+
+        Subclasses may override this to parse their conditions ahead of time.
+        """
+        return ConditionMatcher(self, conditions)
+
     def validate(self, data):
         value = data.get(self.name)
         if value:
@@ -84,9 +119,76 @@ class Choice(Field):
         return value
 
 
+class RangeMatcher(object):
+    """
+    A ``ConditionMatcher`` for ``Range`` conditions, with their bounds parsed
+    ahead of time.
+    """
+    def __init__(self, includes, excludes):
+        self.includes = includes
+        self.excludes = excludes
+
+    def __call__(self, value):
+        for lower, upper in self.excludes:
+            if lower <= value <= upper:
+                return False
+        if self.excludes:
+            return True
+        for lower, upper in self.includes:
+            if lower <= value <= upper:
+                return True
+        return None
+
+
+class PercentMatcher(object):
+    """
+    A ``ConditionMatcher`` for ``Percent`` conditions, which holds the result
+    for each of the 100 buckets a value may fall in.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+    def __call__(self, value):
+        return self.buckets[value % 100]
+
+
 class Range(Field):
+    def parse(self, condition):
+        """
+        Returns the ``(min, max)`` integer bounds of a condition, which is
+        stored as ``"min-max"``.
+        """
+        if isinstance(condition, basestring):
+            condition = condition.split('-')
+        return int(condition[0]), int(condition[1])
+
+    def parse_conditions(self, conditions):
+        """
+        Returns the parsed bounds of the included and excluded conditions,
+        or ``None`` if any of them is invalid.
+        """
+        includes, excludes = [], []
+        for status, condition in conditions:
+            try:
+                bounds = self.parse(condition)
+            except (TypeError, ValueError, IndexError):
+                return None
+            if status == EXCLUDE:
+                excludes.append(bounds)
+            else:
+                includes.append(bounds)
+        return includes, excludes
+
     def is_active(self, condition, value):
-        return value >= condition[0] and value <= condition[1]
+        lower, upper = self.parse(condition)
+        return lower <= value <= upper
+
+    def compile(self, conditions):
+        parsed = self.parse_conditions(conditions)
+        if parsed is None:
+            # fail when checked, rather than when loaded
+            return ConditionMatcher(self, conditions)
+        return RangeMatcher(*parsed)
 
     def validate(self, data):
         value = filter(None, [data.get(self.name + '[min]'), data.get(self.name + '[max]')]) or None
@@ -115,27 +217,117 @@ class Percent(Range):
     default_help_text = 'Enter two ranges. e.g. 0-50 is lower 50%'
 
     def is_active(self, condition, value):
-        condition = map(int, condition.split('-'))
-        mod = value % 100
-        return mod >= condition[0] and mod <= condition[1]
+        lower, upper = self.parse(condition)
+        return lower <= value % 100 <= upper
+
+    def compile(self, conditions):
+        parsed = self.parse_conditions(conditions)
+        if parsed is None:
+            # fail when checked, rather than when loaded
+            return ConditionMatcher(self, conditions)
+
+        includes, excludes = parsed
+        included = excluded = 0
+        for lower, upper in includes:
+            for bucket in xrange(max(lower, 0), min(upper, 99) + 1):
+                included |= 1 << bucket
+        for lower, upper in excludes:
+            for bucket in xrange(max(lower, 0), min(upper, 99) + 1):
+                excluded |= 1 << bucket
+
+        buckets = []
+        for bucket in xrange(100):
+            if excluded & (1 << bucket):
+                buckets.append(False)
+            elif excludes or included & (1 << bucket):
+                buckets.append(True)
+            else:
+                buckets.append(None)
+        return PercentMatcher(tuple(buckets))
 
     def display(self, value):
-        value = value.split('-')
-        return '%s: %s%% (%s-%s)' % (self.label, int(value[1]) - int(value[0]), value[0], value[1])
+        lower, upper = self.parse(value)
+        return '%s: %s%% (%s-%s)' % (self.label, upper - lower, lower, upper)
 
     def clean(self, value):
         value = super(Percent, self).clean(value)
         if value:
-            numeric = value.split('-')
-            if int(numeric[0]) < 0 or int(numeric[1]) > 100:
+            lower, upper = self.parse(value)
+            if lower < 0 or upper > 100:
                 raise ValidationError('You must enter values between 0 and 100.')
-            if int(numeric[0]) > int(numeric[1]):
+            if lower > upper:
                 raise ValidationError('Start value must be less than end value.')
         return value
 
 
+class SetMatcher(object):
+    """
+    A ``ConditionMatcher`` for fields which match on equality, which looks
+    values up in sets of the included and excluded conditions.
+    """
+    def __init__(self, includes, excludes):
+        self.includes = includes
+        self.excludes = excludes
+
+    def __call__(self, value):
+        try:
+            if value in self.excludes:
+                return False
+            elif self.excludes:
+                return True
+            elif value in self.includes:
+                return True
+        except TypeError:
+            # unhashable, so it can't be equal to any condition
+            if self.excludes:
+                return True
+        return None
+
+
 class String(Field):
-    pass
+    def compile(self, conditions):
+        if type(self).is_active.im_func is not Field.is_active.im_func:
+            # matches on something other than equality
+            return super(String, self).compile(conditions)
+
+        includes, excludes = set(), set()
+        try:
+            for status, condition in conditions:
+                if status == EXCLUDE:
+                    excludes.add(condition)
+                else:
+                    includes.add(condition)
+        except TypeError:
+            return super(String, self).compile(conditions)
+        return SetMatcher(frozenset(includes), frozenset(excludes))
+
+
+class DateMatcher(object):
+    """
+    A ``ConditionMatcher`` for ``AbstractDate`` conditions, with their dates
+    parsed ahead of time.
+    """
+    def __init__(self, field, includes, excludes):
+        self.field = field
+        self.includes = includes
+        self.excludes = excludes
+
+    def __call__(self, value):
+        assert isinstance(value, datetime.date)
+        if isinstance(value, datetime.datetime):
+            # datetime.datetime cannot be compared to datetime.date with > and < operators
+            value = value.date()
+
+        date_is_active = self.field.date_is_active
+        for condition_date in self.excludes:
+            if date_is_active(condition_date, value):
+                return False
+        if self.excludes:
+            return True
+        for condition_date in self.includes:
+            if date_is_active(condition_date, value):
+                return True
+        return None
 
 
 class AbstractDate(Field):
@@ -172,6 +364,20 @@ class AbstractDate(Field):
         condition_date = self.str_to_date(condition)
         return self.date_is_active(condition_date, value)
 
+    def compile(self, conditions):
+        includes, excludes = [], []
+        for status, condition in conditions:
+            try:
+                condition_date = self.str_to_date(condition)
+            except (TypeError, ValueError):
+                # fail when checked, rather than when loaded
+                return ConditionMatcher(self, conditions)
+            if status == EXCLUDE:
+                excludes.append(condition_date)
+            else:
+                includes.append(condition_date)
+        return DateMatcher(self, includes, excludes)
+
     def date_is_active(self, condition_date, value):
         raise NotImplementedError
 
@@ -253,6 +459,24 @@ class ConditionSet(object):
             value = value()
         return value
 
+    def compile(self, conditions):
+        """
+        Given the conditions active for a switch, returns a dictionary mapping
+        field names to compiled matchers (see ``Field.compile``) for this
+        ConditionSet's namespace.
+
+        Returns ``None`` if the switch has no conditions in this namespace.
+        """
+        namespace_conditions = conditions.get(self.get_namespace())
+        if not namespace_conditions:
+            return None
+        compiled = {}
+        for name, field in self.fields.iteritems():
+            field_conditions = namespace_conditions.get(name)
+            if field_conditions:
+                compiled[name] = field.compile(field_conditions)
+        return compiled or None
+
     def has_active_condition(self, conditions, instances):
         """
         Given a list of instances, and the conditions active for
@@ -270,25 +494,56 @@ class ConditionSet(object):
                 return_value = True
         return return_value
 
+    def has_active_compiled(self, compiled, instances, values=None):
+        """
+        Same as ``has_active_condition``, but takes the result of
+        ``compile`` rather than the raw conditions.
+
+        ``values``, if given, is a dictionary used to cache field values
+        between checks made against the same instances, keyed by
+        ``(id(instance), condition_set, field_name)``.
+        """
+        return_value = None
+        for instance in itertools.chain(instances, [None]):
+            if not self.can_execute(instance):
+                continue
+            result = self.is_active_compiled(instance, compiled, values)
+            if result is False:
+                return False
+            elif result is True:
+                return_value = True
+        return return_value
+
     def is_active(self, instance, conditions):
         """
         Given an instance, and the conditions active for this switch, returns
         a boolean representing if the feature is active.
         """
+        return self.is_active_compiled(instance, self.compile(conditions) or {})
+
+    def is_active_compiled(self, instance, compiled, values=None):
+        """
+        Same as ``is_active``, but takes the result of ``compile`` rather
+        than the raw conditions.
+        """
         return_value = None
-        for name, field in self.fields.iteritems():
-            field_conditions = conditions.get(self.get_namespace(), {}).get(name)
-            if field_conditions:
+        for name, matcher in compiled.iteritems():
+            if values is None:
                 value = self.get_field_value(instance, name)
-                for status, condition in field_conditions:
-                    exclude = status == EXCLUDE
-                    if field.is_active(condition, value):
-                        if exclude:
-                            return False
-                        return_value = True
-                    else:
-                        if exclude:
-                            return_value = True
+            else:
+                cache_key = (id(instance), self, name)
+                try:
+                    value = values[cache_key][1]
+                except KeyError:
+                    value = self.get_field_value(instance, name)
+                    # hold on to the instance so its id can't be reused
+                    # while the value is cached
+                    values[cache_key] = (instance, value)
+            result = matcher(value)
+            if result is False:
+                return False
+            elif result is True:
+                return_value = True
         return return_value
 
     def get_group_label(self):
@@ -331,3 +586,16 @@ class RequestConditionSet(ConditionSet):
 
     def can_execute(self, instance):
         return isinstance(instance, HttpRequest)
+
+
+class EnvironmentConditionSet(ConditionSet):
+    """
+    A ConditionSet for the environment the process is running in (such as
+    its host), rather than for any instance.
+
+    Its conditions are checked when switches are compiled, so a switch
+    whose conditions are all in environment ConditionSets is constant
+    until the switches are next reloaded.
+    """
+    def can_execute(self, instance):
+        return instance is None
@@ -0,0 +1,89 @@
+import os
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+import gargoyle
+
+
+def get_memory_usage():
+    """
+    Returns the resident and private (not shared with any other process)
+    memory of this process in kB, or ``None`` if ``/proc`` isn't available.
+    """
+    rss = private = 0
+    try:
+        with open('/proc/self/smaps') as fp:
+            for line in fp:
+                if line.startswith('Rss:'):
+                    rss += int(line.split()[1])
+                elif line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                    private += int(line.split()[1])
+    except IOError:
+        return None
+    return rss, private
+
+
+def measure_workers(count):
+    """
+    Forks ``count`` processes, one after the other, which each check every
+    switch, and returns the memory usage of each afterwards.
+    """
+    # forked processes must not share database connections
+    for connection in connections.all():
+        connection.close()
+
+    results = []
+    for i in xrange(count):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_fd)
+                gargoyle.gargoyle.is_active_many(gargoyle.gargoyle.keys())
+                os.write(write_fd, repr(get_memory_usage()))
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as fp:
+            result = fp.read()
+        os.waitpid(pid, 0)
+        if result and result != 'None':
+            results.append(tuple(int(n) for n in result.strip('()').split(',')))
+    return results
+
+
+class Command(BaseCommand):
+    help = 'Loads and compiles all gargoyle switches, and reports how long it took.'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--workers',
+            type='int',
+            default=0,
+            dest='workers',
+            help='Also fork this many workers, before and after loading the switches, and report their memory usage.'),
+    )
+
+    def handle(self, *args, **kwargs):
+        workers = kwargs['workers']
+        if workers:
+            cold = measure_workers(workers)
+
+        started = time.time()
+        snapshot = gargoyle.warm()
+        self.stdout.write('Loaded %d switches in %.1fms' % (len(snapshot.plans), (time.time() - started) * 1000))
+
+        if workers:
+            warm = measure_workers(workers)
+            if not cold or not warm:
+                self.stdout.write('Memory usage is only available on Linux')
+                return
+            for label, results in (('cold', cold), ('warm', warm)):
+                self.stdout.write('%s workers: %dkB resident, %dkB private on average' % (
+                    label,
+                    sum(r[0] for r in results) / len(results),
+                    sum(r[1] for r in results) / len(results),
+                ))
@@ -1,12 +1,43 @@
+import datetime
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+
 from django.conf import settings
 from django.core.cache import get_cache
 from django.http import HttpRequest
-
+from gargoyle import compact
+from gargoyle.backends import ModelBackend, get_backend
+from gargoyle.chunked import DEFAULT_CHUNK_SIZE, FOREVER, get_chunked, set_chunked
+from gargoyle.compiler import ConditionSetIndex, Evaluation, SwitchPlan, SwitchSnapshot, compile_switch, \
+    get_parents
 from gargoyle.models import Switch, DISABLED, SELECTIVE, GLOBAL, INHERIT, \
-    INCLUDE, EXCLUDE
+    INCLUDE, EXCLUDE, now, record_deletion
 from gargoyle.proxy import SwitchProxy
+from gargoyle.refresher import SwitchRefresher
+from gargoyle.shared import HostLock, SharedFile
 
 from modeldict import ModelDict
+from modeldict.base import NoValue
+
+logger = logging.getLogger('gargoyle.manager')
+
+
+def _memoized_by(instances):
+    """
+    Returns the objects whose identities decisions for ``instances`` are
+    memoized by: the instances, along with the users of requests among them,
+    which ``auth.login`` and ``logout`` replace.
+    """
+    objects = []
+    for instance in instances:
+        objects.append(instance)
+        if isinstance(instance, HttpRequest):
+            # without loading a lazy user
+            objects.append(instance.__dict__.get('user'))
+    return objects
 
 
 class SwitchManager(ModelDict):
@@ -18,9 +49,93 @@ class SwitchManager(ModelDict):
     INCLUDE = INCLUDE
     EXCLUDE = EXCLUDE
 
+    # how far before the last seen modification incremental refreshes look,
+    # to allow for clock skew between processes saving switches, and for
+    # transactions committed after they set ``date_modified``
+    incremental_overlap = datetime.timedelta(seconds=10)
+    # how long the tombstones of deleted switches are kept. Switches loaded
+    # longer ago than that are loaded again in full, rather than incrementally.
+    tombstone_retention = datetime.timedelta(days=7)
+
+    # the largest cache entry the switches are split into (see ``gargoyle.chunked``)
+    cache_chunk_size = DEFAULT_CHUNK_SIZE
+    # how long the version and the switches are kept in the remote cache, if
+    # not evicted. Expiring either would reload the switches for nothing.
+    cache_timeout = FOREVER
+
+    # how long a process may hold the lock for reloading the switches from
+    # the database, and how long others keep using the switches they had
+    # loaded while it does (see ``_update_cache_data``)
+    reload_lock_timeout = 10
+    stale_grace = 30
+    # how often processes keeping stale switches check whether they've been
+    # reloaded, and how long processes with nothing to fall back on wait for
+    # them to be (polling every ``reload_poll_interval`` seconds)
+    stale_recheck_interval = 1
+    reload_wait = 5
+    reload_poll_interval = 0.1
+
+    # how long the cache and database are left alone after failing to load
+    # the switches from them (see ``_populate``)
+    backend_retry_interval = 30
+
     def __init__(self, *args, **kwargs):
+        # where the switches are loaded from (see ``gargoyle.backends``),
+        # the model by default
+        backend = kwargs.pop('backend', None)
+        # reload switches in a background thread every ``refresh_interval``
+        # seconds, rather than when checking them (see ``start_refresher``)
+        self.refresh_interval = kwargs.pop('refresh_interval', None)
+        self.max_staleness = kwargs.pop('max_staleness', None)
+        # only load the switches modified since the last load, when they change
+        self.incremental = kwargs.pop('incremental', False)
+        # a file holding the last switches loaded, for when they can't be
+        # loaded otherwise, and to start from
+        self.snapshot_path = kwargs.pop('snapshot_path', None)
+        self._snapshot_path_version = None
+        self._backend_failed_at = None
+        # only load the switches in the one process on the host which holds a
+        # lock, and read them from ``snapshot_path`` in the others. Readers
+        # never check for changes themselves, so the writer has to refresh
+        # the snapshot even when it's idle.
+        self.shared_snapshot = kwargs.pop('shared_snapshot', False)
+        if self.shared_snapshot and not self.snapshot_path:
+            raise ValueError('shared_snapshot requires snapshot_path')
+        if self.shared_snapshot and not self.refresh_interval:
+            raise ValueError('shared_snapshot requires refresh_interval')
+        self._writer_lock = None
+        self._writer_checked_at = None
+        self._shared_file = None
+        self._watermark = None
+        # (old data, new data, changed keys) of the last incremental update
+        self._patch = None
+        # when the loaded switches were first kept while another process reloads them
+        self._stale_since = None
+        # how many times the switches were fetched from the cache, loaded from
+        # the database or the snapshot file, or kept while another process
+        # reloads them, and how many times that failed
+        self.stats = defaultdict(int)
+        self._refresher = None
+        self._refresher_lock = threading.Lock()
         self._registry = {}
+        self._index = ConditionSetIndex()
+        # replaced as a whole, never modified (see ``SwitchSnapshot``)
+        self._snapshot = SwitchSnapshot(None, self._index)
+        # holds the per-request snapshot, decision and field value caches
+        # (see ``enable_request_cache``)
+        self._local = threading.local()
         super(SwitchManager, self).__init__(*args, **kwargs)
+        if backend is None:
+            backend = ModelBackend(self.model, self.key, self.value)
+        self.backend = backend
+
+        # a counter bumped whenever a switch changes, which is all that's
+        # polled to find out whether the switches must be reloaded
+        self.remote_cache_version_key = '%s.version:%s:%s' % (type(self).__name__, self.model.__name__, self.key)
+        # holds the switches, in chunks tagged with their version
+        self.remote_cache_key = '%s:chunked' % (self.remote_cache_key,)
+        self.remote_cache_lock_key = '%s:lock' % (self.remote_cache_key,)
+        self._local_version = None
 
     def __repr__(self):
         return "<%s: %s (%s)>" % (self.__class__.__name__, self.model, self._registry.values())
@@ -31,7 +146,571 @@ class SwitchManager(ModelDict):
         easily extend the Switches method and automatically include our
         manager instance.
         """
-        return SwitchProxy(self, super(SwitchManager, self).__getitem__(key))
+        switch = super(SwitchManager, self).__getitem__(key)
+        if isinstance(switch, compact.CompactSwitch):
+            switch = self._hydrate(switch)
+        return SwitchProxy(self, switch)
+
+    def get(self, key, default=None):
+        switch = super(SwitchManager, self).get(key, default)
+        if isinstance(switch, compact.CompactSwitch):
+            switch = self._hydrate(switch)
+        return switch
+
+    def iteritems(self):
+        return self._hydrate_all().iteritems()
+
+    def itervalues(self):
+        return self._hydrate_all().itervalues()
+
+    def items(self):
+        return self._hydrate_all().items()
+
+    def _hydrate(self, switch, instance=None):
+        """
+        Returns the ``Switch`` instance of a ``CompactSwitch``, which takes
+        its place among the loaded switches, so changes made to it (even
+        unsaved) are checked.
+        """
+        if instance is None:
+            instance = self.backend.get_instance(switch.key)
+        if instance is None:
+            # deleted since the switches were loaded
+            instance = self.model(key=switch.key, status=switch.status, value=switch.value)
+        data = self._local_cache
+        if data is not None and data.get(switch.key) is switch:
+            data[switch.key] = instance
+        return instance
+
+    def _hydrate_all(self):
+        """
+        Returns the loaded switches, as ``Switch`` instances (see
+        ``_hydrate``), loading those which aren't yet all at once.
+        """
+        self._populate()
+        data = self._local_cache
+        switches = [s for s in data.itervalues() if isinstance(s, compact.CompactSwitch)]
+        if switches:
+            instances = self.backend.get_instances([s.key for s in switches])
+            for switch in switches:
+                self._hydrate(switch, instances.get(switch.key))
+        return data
+
+    def _get_snapshot(self):
+        """
+        Returns the ``SwitchSnapshot`` to check switches against.
+
+        While the request cache is enabled, this is the same snapshot for the
+        whole request (unless this process changes a switch), so a request
+        never sees a mix of old and new switches.
+        """
+        local = self._local
+        snapshot = getattr(local, 'snapshot', None)
+        if snapshot is None:
+            snapshot = self._load_snapshot()
+            if getattr(local, 'decisions', None) is not None:
+                local.snapshot = snapshot
+        return snapshot
+
+    def _load_snapshot(self):
+        """
+        Returns the current ``SwitchSnapshot``.
+
+        If a refresher is running and fresh, this is whatever it last loaded.
+        Otherwise the switches are reloaded if needed, as ModelDict does.
+
+        With ``shared_snapshot``, only the process which writes the snapshot
+        runs a refresher.
+        """
+        if self.refresh_interval and (not self.shared_snapshot or self._is_snapshot_writer()):
+            refresher = self._refresher
+            if refresher is not None and refresher.is_fresh():
+                snapshot = self._snapshot
+                if snapshot.data is not None and snapshot.index is self._index:
+                    return snapshot
+            else:
+                # not started yet, lost in a fork, or fallen behind
+                refresher = self.start_refresher()
+                if refresher.last_refreshed is not None:
+                    # don't serve anything older than max_staleness
+                    refresher.refresh()
+        return self._build_snapshot()
+
+    def _build_snapshot(self):
+        """
+        Returns the current ``SwitchSnapshot``, building a new one whenever
+        the underlying data has been (re)loaded.
+        """
+        data = self._populate()
+        snapshot = self._snapshot
+        index = self._index
+        if data is not snapshot.data or index is not snapshot.index:
+            patch = self._patch
+            if patch is not None and patch[0] is snapshot.data and patch[1] is data and index is snapshot.index:
+                snapshot = snapshot.patch(data, patch[2])
+            else:
+                snapshot = SwitchSnapshot(data, index)
+            self._snapshot = snapshot
+        return snapshot
+
+    def _populate(self, reset=False):
+        """
+        Ensures the switches are loaded, and are those of the current version.
+
+        Unlike ``ModelDict``, only the version is fetched from the remote cache
+        when checking for changes, and the switches are only fetched when it
+        has changed. ``reset`` reloads the switches from the database.
+
+        If ``snapshot_path`` is set, the switches are first loaded from there.
+        Should loading them from the cache or the database then fail, the
+        switches already loaded keep being used, without trying again for
+        ``backend_retry_interval`` seconds.
+
+        With ``shared_snapshot``, the switches are read from ``snapshot_path``
+        rather than loaded, unless this process writes it.
+        """
+        if self.shared_snapshot and not reset and not self._is_snapshot_writer():
+            if self._read_shared_snapshot():
+                return self._local_cache
+            # nothing written yet
+
+        if self._local_cache is None and self.snapshot_path:
+            self._read_snapshot_path()
+
+        failed_at = self._backend_failed_at
+        if failed_at is not None and not reset and self._local_cache is not None:
+            if time.time() - failed_at < self.backend_retry_interval:
+                return self._local_cache
+
+        try:
+            self._populate_from_backend(reset)
+        except Exception:
+            self._backend_failed_at = time.time()
+            self.stats['backend_errors'] += 1
+            if self._local_cache is None:
+                raise
+            logger.exception('Unable to load switches, using those loaded before')
+        else:
+            self._backend_failed_at = None
+        return self._local_cache
+
+    def _populate_from_backend(self, reset=False):
+        if reset:
+            self._update_cache_data(reload=True)
+        elif self.local_cache_has_expired():
+            version = self._get_version()
+            if version != self._local_version:
+                if self._can_update_incrementally():
+                    self._update_incrementally(version)
+                elif not self._update_cache_data(stale_ok=self._local_cache is not None):
+                    # check again shortly, until they're reloaded
+                    self._last_checked_for_remote_changes = time.time() - self.timeout + self.stale_recheck_interval
+                    return
+            self._last_checked_for_remote_changes = int(time.time())
+
+        if self._local_cache is None:
+            self._update_cache_data()
+
+    def _read_snapshot_path(self):
+        """
+        Loads the switches from ``snapshot_path``, if they were written there.
+        """
+        loaded = compact.read(self.snapshot_path)
+        if loaded is not None:
+            self._local_cache, self._watermark, self._local_version = loaded
+            self._snapshot_path_version = self._local_version
+            self._patch = None
+            self.stats['snapshot_path_loads'] += 1
+
+    def _is_snapshot_writer(self):
+        """
+        Returns ``True`` if this process writes the shared snapshot, trying to
+        become the one which does every ``timeout`` seconds, in case the
+        process which did has exited.
+        """
+        lock = self._writer_lock
+        if lock is None:
+            lock = self._writer_lock = HostLock('%s.lock' % (self.snapshot_path,))
+        elif lock.is_held():
+            return True
+        now = time.time()
+        if self._writer_checked_at is not None and now - self._writer_checked_at < self.timeout:
+            return False
+        self._writer_checked_at = now
+        return lock.acquire()
+
+    def _read_shared_snapshot(self):
+        """
+        Loads the switches from the shared snapshot, if it was replaced since
+        they were last loaded from it.
+
+        Returns ``False`` if it hasn't been written yet.
+        """
+        shared_file = self._shared_file
+        if shared_file is not None and shared_file.is_current():
+            return True
+        try:
+            new_file = SharedFile(self.snapshot_path)
+        except (EnvironmentError, ValueError):
+            return shared_file is not None
+
+        if shared_file is None or new_file.generation != shared_file.generation:
+            loaded = compact.loads(new_file.read())
+            if loaded is None:
+                new_file.close()
+                return shared_file is not None
+            self._local_cache, self._watermark, self._local_version = loaded
+            self._patch = None
+            self.stats['shared_loads'] += 1
+
+        if shared_file is not None:
+            shared_file.close()
+        self._shared_file = new_file
+        return True
+
+    def _write_snapshot_path(self):
+        """
+        Writes the loaded switches to ``snapshot_path``, unless they already were.
+        """
+        if not self.snapshot_path or self._local_version == self._snapshot_path_version:
+            return
+        try:
+            compact.write(self.snapshot_path, self._local_cache, self._watermark, self._local_version)
+        except Exception:
+            logger.exception('Unable to write switches to %s', self.snapshot_path)
+        else:
+            self._snapshot_path_version = self._local_version
+
+    def _get_version(self):
+        """
+        Returns the version of the switches, which changes whenever they do.
+        """
+        if self.backend.cached:
+            return self.remote_cache.get(self.remote_cache_version_key)
+        return self.backend.get_version()
+
+    def _update_cache_data(self, reload=False, stale_ok=False):
+        """
+        Loads the switches of the current version, from the remote cache if
+        they're there (and ``reload`` is ``False``), or from the backend
+        otherwise, in which case they're published to the remote cache.
+
+        Only one process at a time loads them from the backend, holding a
+        lock in the remote cache. Meanwhile, if ``stale_ok`` is ``True``, the
+        others keep the switches they had loaded, for up to ``stale_grace``
+        seconds, and ``False`` is returned. Those with nothing to fall back on
+        wait up to ``reload_wait`` seconds for the switches to be published.
+
+        Backends which aren't ``cached`` are always loaded from.
+        """
+        if not self.backend.cached:
+            version = self.backend.get_version()
+            loaded = self.backend.load()
+            self.stats['reloads'] += 1
+        else:
+            version = self.remote_cache.get(self.remote_cache_version_key)
+            if version is None:
+                version = self._init_version()
+            loaded = self._load_cached(version, reload, stale_ok)
+            if loaded is None:
+                return False
+
+        self._local_cache, self._watermark = loaded
+        self._local_version = version
+        self._local_last_updated = self._last_checked_for_remote_changes = int(time.time())
+        self._stale_since = None
+        self._patch = None
+        self._write_snapshot_path()
+        return True
+
+    def _load_cached(self, version, reload=False, stale_ok=False):
+        """
+        Returns the switches of ``version`` (see ``_update_cache_data``), or
+        ``None`` if the stale switches should be kept.
+        """
+        loaded = None
+        if version is not None and not reload:
+            loaded = compact.load(get_chunked(self.remote_cache, self.remote_cache_key, tag=version))
+        if loaded is not None:
+            self.stats['cache_hits'] += 1
+            return loaded
+
+        lock = None
+        if version is not None and not reload:
+            lock = self._acquire_reload_lock()
+            if lock is None:
+                if stale_ok and self._keep_stale():
+                    return None
+                # nothing to fall back on, or it has been too long
+                loaded = self._wait_for_reload(version)
+                if loaded is not None:
+                    return loaded
+                self.stats['lock_contended'] += 1
+        try:
+            loaded = self.backend.load()
+            if version is not None:
+                set_chunked(self.remote_cache, self.remote_cache_key, compact.dump(*loaded),
+                            self.cache_chunk_size, timeout=self.cache_timeout, tag=version)
+        finally:
+            if lock is not None:
+                self._release_reload_lock(lock)
+        self.stats['reloads'] += 1
+        return loaded
+
+    def _wait_for_reload(self, version):
+        """
+        Returns the switches of ``version`` once they've been published by the
+        process reloading them, or ``None`` if it takes over ``reload_wait``
+        seconds.
+        """
+        deadline = time.time() + self.reload_wait
+        while time.time() < deadline:
+            time.sleep(self.reload_poll_interval)
+            loaded = compact.load(get_chunked(self.remote_cache, self.remote_cache_key, tag=version))
+            if loaded is not None:
+                self.stats['reload_waits'] += 1
+                return loaded
+        return None
+
+    def _acquire_reload_lock(self):
+        """
+        Returns a token if this process may reload the switches from the
+        database, or ``None`` if another one already is.
+        """
+        token = uuid.uuid4().hex
+        if self.remote_cache.add(self.remote_cache_lock_key, token, self.reload_lock_timeout):
+            return token
+        return None
+
+    def _release_reload_lock(self, token):
+        # unless it expired and was taken by another process
+        if self.remote_cache.get(self.remote_cache_lock_key) == token:
+            self.remote_cache.delete(self.remote_cache_lock_key)
+
+    def _keep_stale(self):
+        """
+        Returns ``True`` if the loaded switches may still be used while another
+        process reloads them.
+        """
+        now = time.time()
+        if self._stale_since is None:
+            self._stale_since = now
+        elif now - self._stale_since > self.stale_grace:
+            return False
+        self.stats['stale_hits'] += 1
+        return True
+
+    def _get_cache_data(self):
+        return self.backend.load()[0]
+
+    def get_default(self, key):
+        if not self.auto_create:
+            return NoValue
+        switch = self.backend.create(key)
+        if switch is None:
+            return NoValue
+        return switch
+
+    def _can_update_incrementally(self):
+        """
+        Returns ``True`` if the switches loaded can be brought up to date with
+        those modified since, which requires the tombstones of those deleted
+        since not to have been pruned.
+        """
+        if not self.incremental or not self.backend.supports_incremental:
+            return False
+        if self._local_cache is None or self._watermark is None:
+            return False
+        return now() - self._watermark + self.incremental_overlap < self.tombstone_retention
+
+    def _update_incrementally(self, version):
+        """
+        Loads the switches modified, and the tombstones of those deleted (see
+        ``DeletedSwitch``), since the last load, and applies them to a copy of
+        the loaded switches.
+        """
+        since = self._watermark - self.incremental_overlap
+        old = self._local_cache
+        switches, watermark, tombstones = self.backend.load_modified(since)
+        modified, changed = set(switches), {}
+        for key, switch in switches.iteritems():
+            current = old.get(key)
+            # skip what was already loaded, as the window overlaps the last one
+            if current is None or (current.status, current.value) != (switch.status, switch.value):
+                changed[key] = switch
+
+        # a switch created again after being deleted was modified since
+        deleted = set(tombstones).intersection(old).difference(modified)
+
+        data = dict(old)
+        for key in deleted:
+            del data[key]
+        data.update(changed)
+
+        self._watermark = max([w for w in [self._watermark, watermark] if w is not None] + tombstones.values())
+        self._patch = (old, data, deleted.union(changed))
+        self._local_cache = data
+        self._local_version = version
+        self._local_last_updated = int(time.time())
+        self._write_snapshot_path()
+
+    def _init_version(self):
+        # start from the time, rather than 1, so a version is never reused
+        # if the key is evicted (leaving room for 2 ** 20 bumps a millisecond)
+        self.remote_cache.add(self.remote_cache_version_key, int(time.time() * 1000) << 20, self.cache_timeout)
+        return self.remote_cache.get(self.remote_cache_version_key)
+
+    def _bump_version(self):
+        """
+        Tells every process the switches have changed.
+        """
+        try:
+            self.remote_cache.incr(self.remote_cache_version_key)
+        except ValueError:
+            # not set, or evicted
+            self._init_version()
+
+    def refresh(self):
+        """
+        Checks whether the switches have changed, reloading them and building
+        a new snapshot if they have.
+
+        This is what the refresher runs every ``refresh_interval`` seconds.
+        """
+        # force ModelDict to check for changes, however recently it did
+        super(SwitchManager, self)._cleanup()
+        self._build_snapshot()
+
+    def warm(self):
+        """
+        Loads the switches and compiles them, returning the ``SwitchSnapshot``.
+
+        Unlike checking a switch, this never starts a refresher, nor takes
+        over writing the shared snapshot, as neither survives forking. See
+        ``gargoyle.warm``.
+        """
+        if self.shared_snapshot:
+            # leave it to the forked processes (see ``_is_snapshot_writer``)
+            self._writer_checked_at = time.time()
+        return self._build_snapshot()
+
+    def start_refresher(self):
+        """
+        Starts a ``SwitchRefresher`` for ``refresh_interval``, unless one is
+        already running.
+
+        While it is fresh (see ``max_staleness``, which defaults to three times
+        ``refresh_interval``), checking a switch never loads anything. If it
+        falls further behind, the next check refreshes the switches itself.
+
+        This is called when a switch is first checked, so it's rarely needed,
+        but it can be used to load the switches before serving requests.
+        """
+        if not self.refresh_interval:
+            raise ValueError('refresh_interval is not set')
+        with self._refresher_lock:
+            refresher = self._refresher
+            if refresher is not None and refresher.is_alive():
+                return refresher
+            max_staleness = self.max_staleness or self.refresh_interval * 3
+            refresher = self._refresher = SwitchRefresher(self, self.refresh_interval, max_staleness)
+            refresher.start()
+            return refresher
+
+    def stop_refresher(self):
+        """
+        Stops the running ``SwitchRefresher``, if any.
+        """
+        with self._refresher_lock:
+            refresher, self._refresher = self._refresher, None
+        if refresher is not None:
+            refresher.stop()
+
+    def _get_compiled(self):
+        """
+        Returns ``(plans, constants)`` of the current snapshot.
+        """
+        snapshot = self._get_snapshot()
+        return snapshot.plans, snapshot.constants
+
+    def _get_plans(self):
+        """
+        Returns the compiled ``SwitchPlan`` of every switch by key.
+        """
+        return self._get_snapshot().plans
+
+    def _get_plan(self, key):
+        """
+        Returns the compiled ``SwitchPlan`` for ``key``.
+
+        Raises ``KeyError`` if the switch does not exist.
+        """
+        return self._get_plans()[key]
+
+    def invalidate_plans(self):
+        """
+        Discards all compiled plans, forcing them to be compiled again on
+        the next check.
+        """
+        self._snapshot = SwitchSnapshot(None, self._index)
+        self.clear_request_cache()
+
+    def _registry_changed(self):
+        self._index = ConditionSetIndex(self._registry.itervalues())
+        self.invalidate_plans()
+
+    def _post_save(self, *args, **kwargs):
+        self._bump_version()
+        super(SwitchManager, self)._post_save(*args, **kwargs)
+        # don't wait for the refresher to see our own changes
+        self.invalidate_plans()
+
+    def _post_delete(self, *args, **kwargs):
+        if self.incremental and self.backend.supports_incremental:
+            record_deletion(getattr(kwargs['instance'], self.key), self.tombstone_retention)
+        self._bump_version()
+        super(SwitchManager, self)._post_delete(*args, **kwargs)
+        self.invalidate_plans()
+
+    def _cleanup(self, *args, **kwargs):
+        super(SwitchManager, self)._cleanup(*args, **kwargs)
+        # in case the request ended without going through the middleware
+        self.disable_request_cache()
+
+    def enable_request_cache(self):
+        """
+        Memoizes ``is_active`` decisions on the current thread, by switch key
+        and the identities of the instances passed in (and of the users of
+        requests), until
+        ``disable_request_cache`` is called. Switches are also checked against
+        the same snapshot until then.
+
+        The values of fields checked by conditions are also cached by the
+        identity of their instance, so each is only looked up once.
+
+        This is generally handled by ``gargoyle.middleware.SwitchCacheMiddleware``.
+        """
+        self._local.snapshot = None
+        self._local.decisions = {}
+        self._local.values = {}
+
+    def disable_request_cache(self):
+        """
+        Discards the current thread's caches and stops memoizing.
+        """
+        self._local.snapshot = None
+        self._local.decisions = None
+        self._local.values = None
+
+    def clear_request_cache(self):
+        """
+        Discards anything memoized on the current thread, without disabling
+        the request cache.
+        """
+        if getattr(self._local, 'decisions', None) is not None:
+            self._local.snapshot = None
+            self._local.decisions = {}
+            self._local.values = {}
 
     def is_active(self, key, *instances, **kwargs):
         """
@@ -40,14 +719,101 @@ class SwitchManager(ModelDict):
 
         >>> gargoyle.is_active('my_feature', request) #doctest: +SKIP
         """
+        snapshot = self._get_snapshot()
+        # most switches are simply on or off
+        constant = snapshot.constants.get(key, NoValue)
+        if constant is not NoValue:
+            if constant is None:
+                return kwargs.get('default', False)
+            return constant
+
+        default = kwargs.get('default', False)
+        decisions = getattr(self._local, 'decisions', None)
+        if decisions is None:
+            return self._is_active(key, instances, default, snapshot)
+
+        memoized_by = _memoized_by(instances)
+        cache_key = (key, default, tuple(id(o) for o in memoized_by))
+        try:
+            return decisions[cache_key][1]
+        except KeyError:
+            result = self._is_active(key, instances, default, snapshot)
+            # hold on to the instances so their ids can't be reused while
+            # the decision is cached
+            decisions[cache_key] = (memoized_by, result)
+            return result
+
+    def _is_active(self, key, instances, default, snapshot):
+        evaluation = Evaluation(instances, getattr(self._local, 'values', None), snapshot.index)
+        return self._check(key, evaluation, default, snapshot)
+
+    def is_active_many(self, keys, *instances, **kwargs):
+        """
+        Returns a dictionary mapping each of ``keys`` to the result of
+        ``is_active`` for ``instances``.
+
+        Work which only depends on ``instances``, such as looking up the
+        user of a request or the values of fields checked by conditions, is
+        shared between all switches, as are the results of common parents.
+
+        >>> gargoyle.is_active_many(['my_feature', 'my_other_feature'], request) #doctest: +SKIP
+        {'my_feature': True, 'my_other_feature': False}
+        """
         default = kwargs.pop('default', False)
+        snapshot = self._get_snapshot()
+        evaluation = Evaluation(instances, getattr(self._local, 'values', None), snapshot.index)
+        decisions = getattr(self._local, 'decisions', None)
+        if decisions is None:
+            return dict((key, self._check(key, evaluation, default, snapshot)) for key in keys)
+
+        memoized_by = _memoized_by(instances)
+        instance_ids = tuple(id(o) for o in memoized_by)
+        results = {}
+        for key in keys:
+            cache_key = (key, default, instance_ids)
+            try:
+                result = decisions[cache_key][1]
+            except KeyError:
+                result = self._check(key, evaluation, default, snapshot)
+                decisions[cache_key] = (memoized_by, result)
+            results[key] = result
+        return results
+
+    def _check(self, key, evaluation, default, snapshot):
+        """
+        Checks ``key`` for the instances of ``evaluation``, against ``snapshot``.
+        """
+        plans = snapshot.plans
+        try:
+            plan = plans[key]
+        except KeyError:
+            if self.auto_create:
+                # the switch, or its parents, may be created along the way
+                return self._evaluate(key, default, evaluation, snapshot)
+            # switch is not defined, defer to parents
+            plan = SwitchPlan(key, INHERIT, [])
+            plan.link(get_parents(key, plans))
+        return plan.check(evaluation, default)
+
+    def _is_active_recursive(self, key, *instances, **kwargs):
+        """
+        Same as ``is_active``, but looks up each parent of ``key`` through
+        ``is_active`` (which may be patched, see ``gargoyle.testutils``)
+        rather than relying on the compiled plans.
+        """
+        default = kwargs.pop('default', False)
+        snapshot = self._get_snapshot()
+        evaluation = Evaluation(instances, getattr(self._local, 'values', None), snapshot.index)
+        return self._evaluate(key, default, evaluation, snapshot)
 
+    def _evaluate(self, key, default, evaluation, snapshot):
+        """
+        Checks ``key`` for the instances of ``evaluation``, looking up the state
+        of its parents in turn.
+        """
         # Check all parents for a disabled state
-        parts = key.split(':')
-        if len(parts) > 1:
-            child_kwargs = kwargs.copy()
-            child_kwargs['default'] = None
-            result = self.is_active(':'.join(parts[:-1]), *instances, **child_kwargs)
+        if ':' in key:
+            result = self.is_active(key.rsplit(':', 1)[0], *evaluation.instances, default=None)
 
             if result is False:
                 return result
@@ -55,42 +821,16 @@ class SwitchManager(ModelDict):
                 default = result
 
         try:
-            switch = self[key]
-        except KeyError:
-            # switch is not defined, defer to parent
-            return default
+            switch = snapshot.data[key]
+        except (KeyError, TypeError):
+            try:
+                # may create the switch
+                switch = super(SwitchManager, self).__getitem__(key)
+            except KeyError:
+                # switch is not defined, defer to parent
+                return default
 
-        if switch.status == GLOBAL:
-            return True
-        elif switch.status == DISABLED:
-            return False
-        elif switch.status == INHERIT:
-            return default
-
-        conditions = switch.value
-        # If no conditions are set, we inherit from parents
-        if not conditions:
-            return default
-
-        if instances:
-            # HACK: support request.user by swapping in User instance
-            instances = list(instances)
-            for v in instances:
-                if isinstance(v, HttpRequest) and hasattr(v, 'user'):
-                    instances.append(v.user)
-
-        # check each switch to see if it can execute
-        return_value = False
-
-        for switch in self._registry.itervalues():
-            result = switch.has_active_condition(conditions, instances)
-            if result is False:
-                return False
-            elif result is True:
-                return_value = True
-
-        # there were no matching conditions, so it must not be enabled
-        return return_value
+        return compile_switch(switch, snapshot.index).check(evaluation, default)
 
     def register(self, condition_set):
         """
@@ -103,6 +843,7 @@ class SwitchManager(ModelDict):
         if callable(condition_set):
             condition_set = condition_set()
         self._registry[condition_set.get_id()] = condition_set
+        self._registry_changed()
 
     def unregister(self, condition_set):
         """
@@ -113,6 +854,7 @@ class SwitchManager(ModelDict):
         if callable(condition_set):
             condition_set = condition_set()
         self._registry.pop(condition_set.get_id(), None)
+        self._registry_changed()
 
     def get_condition_set_by_id(self, switch_id):
         """
@@ -146,10 +888,27 @@ class SwitchManager(ModelDict):
         return MockRequest(user, ip_address)
 
 
+if getattr(settings, 'GARGOYLE_BACKEND', None):
+    backend = get_backend(settings.GARGOYLE_BACKEND, **getattr(settings, 'GARGOYLE_BACKEND_OPTIONS', {}))
+else:
+    backend = None
+
 if hasattr(settings, 'GARGOYLE_CACHE_NAME'):
     gargoyle = SwitchManager(Switch, key='key', value='value', instances=True,
                          auto_create=getattr(settings, 'GARGOYLE_AUTO_CREATE', True),
+                         refresh_interval=getattr(settings, 'GARGOYLE_REFRESH_INTERVAL', None),
+                         max_staleness=getattr(settings, 'GARGOYLE_MAX_STALENESS', None),
+                         incremental=getattr(settings, 'GARGOYLE_INCREMENTAL_REFRESH', False),
+                         snapshot_path=getattr(settings, 'GARGOYLE_SNAPSHOT_PATH', None),
+                         shared_snapshot=getattr(settings, 'GARGOYLE_SHARED_SNAPSHOT', False),
+                         backend=backend,
                          cache=get_cache(settings.GARGOYLE_CACHE_NAME))
 else:
     gargoyle = SwitchManager(Switch, key='key', value='value', instances=True,
-                         auto_create=getattr(settings, 'GARGOYLE_AUTO_CREATE', True))
+                         auto_create=getattr(settings, 'GARGOYLE_AUTO_CREATE', True),
+                         refresh_interval=getattr(settings, 'GARGOYLE_REFRESH_INTERVAL', None),
+                         max_staleness=getattr(settings, 'GARGOYLE_MAX_STALENESS', None),
+                         incremental=getattr(settings, 'GARGOYLE_INCREMENTAL_REFRESH', False),
+                         snapshot_path=getattr(settings, 'GARGOYLE_SNAPSHOT_PATH', None),
+                         shared_snapshot=getattr(settings, 'GARGOYLE_SHARED_SNAPSHOT', False),
+                         backend=backend)
@@ -0,0 +1,27 @@
+"""
+gargoyle.middleware
+~~~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from gargoyle import gargoyle
+
+
+class SwitchCacheMiddleware(object):
+    """
+    Memoizes ``gargoyle.is_active`` decisions for the duration of a request,
+    so asking the same question several times (e.g. from templates, the
+    ``switch_is_active`` decorator and view code) only evaluates it once.
+    The values checked by conditions (such as the user's attributes, or the
+    parsed IP address) are also only looked up once per request.
+
+    Add it to ``MIDDLEWARE_CLASSES`` before any middleware which checks switches.
+    """
+    def process_request(self, request):
+        gargoyle.enable_request_cache()
+
+    def process_response(self, request, response):
+        gargoyle.disable_request_cache()
+        return response
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+
+        # Adding index on 'Switch', fields ['date_modified']
+        db.create_index('gargoyle_switch', ['date_modified'])
+
+        # Adding model 'DeletedSwitch'
+        db.create_table('gargoyle_deletedswitch', (
+            ('key', self.gf('django.db.models.fields.CharField')(max_length=64, primary_key=True)),
+            ('date_deleted', self.gf('django.db.models.fields.DateTimeField')(default=datetime.datetime.now, db_index=True)),
+        ))
+        db.send_create_signal('gargoyle', ['DeletedSwitch'])
+
+    def backwards(self, orm):
+
+        # Removing index on 'Switch', fields ['date_modified']
+        db.delete_index('gargoyle_switch', ['date_modified'])
+
+        # Deleting model 'DeletedSwitch'
+        db.delete_table('gargoyle_deletedswitch')
+
+    models = {
+        'gargoyle.deletedswitch': {
+            'Meta': {'object_name': 'DeletedSwitch'},
+            'date_deleted': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'db_index': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '64', 'primary_key': 'True'})
+        },
+        'gargoyle.switch': {
+            'Meta': {'object_name': 'Switch'},
+            'date_created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'date_modified': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'description': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '64', 'primary_key': 'True'}),
+            'label': ('django.db.models.fields.CharField', [], {'max_length': '64', 'null': 'True'}),
+            'status': ('django.db.models.fields.PositiveSmallIntegerField', [], {'default': '1'}),
+            'value': ('jsonfield.fields.JSONField', [], {'default': "'{}'"})
+        }
+    }
+
+    complete_apps = ['gargoyle']
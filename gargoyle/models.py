@@ -58,7 +58,7 @@ class Switch(models.Model):
     value = JSONField(default="{}")
     label = models.CharField(max_length=64, null=True)
     date_created = models.DateTimeField(default=now)
-    date_modified = models.DateTimeField(auto_now=True)
+    date_modified = models.DateTimeField(auto_now=True, db_index=True)
     description = models.TextField(null=True)
     status = models.PositiveSmallIntegerField(default=DISABLED, choices=STATUS_CHOICES)
 
@@ -242,3 +242,31 @@ class Switch(models.Model):
             status = self.status
 
         return self.STATUS_LABELS[status]
+
+
+class DeletedSwitch(models.Model):
+    """
+    A tombstone left behind by a deleted ``Switch``, so processes which only
+    load the switches modified since they last looked (see
+    ``SwitchManager.incremental``) notice it is gone.
+    """
+    key = models.CharField(max_length=64, primary_key=True)
+    date_deleted = models.DateTimeField(default=now, db_index=True)
+
+    class Meta:
+        verbose_name = _('deleted switch')
+        verbose_name_plural = _('deleted switches')
+
+    def __unicode__(self):
+        return self.key
+
+
+def record_deletion(key, retention):
+    """
+    Leaves a tombstone for the deleted switch ``key``, and prunes those left
+    more than ``retention`` (a ``timedelta``) ago.
+    """
+    deleted = now()
+    if not DeletedSwitch.objects.filter(key=key).update(date_deleted=deleted):
+        DeletedSwitch.objects.create(key=key, date_deleted=deleted)
+    DeletedSwitch.objects.filter(date_deleted__lt=deleted - retention).delete()
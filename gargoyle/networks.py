@@ -0,0 +1,87 @@
+"""
+gargoyle.networks
+~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import socket
+import struct
+
+
+def parse_ip(ip):
+    """
+    Given an IPv4 or IPv6 address, returns a tuple of its length in bits
+    and its integer value.
+
+    Raises ``ValueError`` if ``ip`` isn't a valid address.
+    """
+    if not isinstance(ip, basestring):
+        raise ValueError('Invalid IP Address %r' % (ip,))
+    try:
+        if ':' in ip:
+            hi, lo = struct.unpack('!QQ', socket.inet_pton(socket.AF_INET6, ip))
+            return 128, (hi << 64) | lo
+        return 32, struct.unpack('!I', socket.inet_pton(socket.AF_INET, ip))[0]
+    except (socket.error, UnicodeError):
+        raise ValueError('Invalid IP Address %r' % (ip,))
+
+
+def parse_network(network):
+    """
+    Given a network in CIDR notation (e.g. ``10.0.0.0/8``), or a single
+    address, returns a tuple of its address length in bits, its prefix
+    and the length of its prefix.
+
+    Raises ``ValueError`` if ``network`` isn't a valid network.
+    """
+    if not isinstance(network, basestring):
+        raise ValueError('Invalid IP Network %r' % (network,))
+    address, sep, prefixlen = network.partition('/')
+    bits, value = parse_ip(address)
+    if sep:
+        if not prefixlen.isdigit() or not 0 <= int(prefixlen) <= bits:
+            raise ValueError('Invalid IP Network %r' % (network,))
+        prefixlen = int(prefixlen)
+    else:
+        prefixlen = bits
+    return bits, value >> (bits - prefixlen), prefixlen
+
+
+class PrefixSet(object):
+    """
+    A set of IPv4 and IPv6 networks, indexed by prefix length.
+
+    Checking whether an address (as returned by ``parse_ip``) belongs to any
+    of the networks takes one set lookup per distinct prefix length, so it
+    is bounded by the length of the address rather than the number of
+    networks.
+    """
+    def __init__(self, networks=()):
+        # bits -> prefix length -> prefixes
+        self._networks = {32: {}, 128: {}}
+        self._lengths = {32: (), 128: ()}
+        for network in networks:
+            self.add(network)
+
+    def __contains__(self, address):
+        bits, value = address
+        networks = self._networks[bits]
+        for prefixlen in self._lengths[bits]:
+            if value >> (bits - prefixlen) in networks[prefixlen]:
+                return True
+        return False
+
+    def __len__(self):
+        return sum(len(prefixes) for networks in self._networks.itervalues() for prefixes in networks.itervalues())
+
+    def add(self, network):
+        """
+        Adds ``network`` (see ``parse_network``) to the set.
+        """
+        bits, prefix, prefixlen = parse_network(network)
+        networks = self._networks[bits]
+        networks.setdefault(prefixlen, set()).add(prefix)
+        # check the shortest prefixes, which cover the most addresses, first
+        self._lengths[bits] = tuple(sorted(networks))
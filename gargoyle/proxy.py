@@ -14,15 +14,23 @@ class SwitchProxy(object):
             object.__setattr__(self, attr, value)
         else:
             setattr(self._switch, attr, value)
+            # the switch may be changed without being saved
+            self._manager.invalidate_plans()
 
     def add_condition(self, *args, **kwargs):
-        return self._switch.add_condition(self._manager, *args, **kwargs)
+        result = self._switch.add_condition(self._manager, *args, **kwargs)
+        self._manager.invalidate_plans()
+        return result
 
     def remove_condition(self, *args, **kwargs):
-        return self._switch.remove_condition(self._manager, *args, **kwargs)
+        result = self._switch.remove_condition(self._manager, *args, **kwargs)
+        self._manager.invalidate_plans()
+        return result
 
     def clear_conditions(self, *args, **kwargs):
-        return self._switch.clear_conditions(self._manager, *args, **kwargs)
+        result = self._switch.clear_conditions(self._manager, *args, **kwargs)
+        self._manager.invalidate_plans()
+        return result
 
     def get_active_conditions(self, *args, **kwargs):
         return self._switch.get_active_conditions(self._manager, *args, **kwargs)
@@ -0,0 +1,77 @@
+"""
+gargoyle.refresher
+~~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import logging
+import threading
+import time
+
+try:
+    from django.db import close_old_connections
+except ImportError:  # django < 1.6
+    from django.db import connections
+
+    def close_old_connections():
+        for connection in connections.all():
+            connection.close()
+
+logger = logging.getLogger('gargoyle.refresher')
+
+
+class SwitchRefresher(threading.Thread):
+    """
+    A daemon thread which reloads the switches of a ``SwitchManager`` (see
+    ``SwitchManager.refresh``) every ``interval`` seconds, so checking a
+    switch doesn't have to.
+
+    The manager only relies on the refresher while it is fresh, that is while
+    its last successful refresh was at most ``max_staleness`` seconds ago.
+    """
+    def __init__(self, manager, interval, max_staleness):
+        super(SwitchRefresher, self).__init__(name='gargoyle-refresher')
+        self.daemon = True
+        self.manager = manager
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self.last_refreshed = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            # nothing sends request_started or request_finished on this
+            # thread, so its database connections are closed here instead,
+            # rather than kept after they time out or fail
+            close_old_connections()
+            try:
+                self.refresh()
+            finally:
+                close_old_connections()
+            self._stopped.wait(self.interval)
+
+    def refresh(self):
+        """
+        Refreshes the switches of the manager, returning ``True`` if it worked.
+        """
+        started = time.time()
+        try:
+            self.manager.refresh()
+        except Exception:
+            logger.exception('Unable to refresh switches')
+            return False
+        self.last_refreshed = started
+        return True
+
+    def is_fresh(self):
+        """
+        Returns ``True`` if the switches were refreshed within the last
+        ``max_staleness`` seconds.
+        """
+        last_refreshed = self.last_refreshed
+        return last_refreshed is not None and time.time() - last_refreshed <= self.max_staleness
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,160 @@
+"""
+gargoyle.shared
+~~~~~~~~~~~~~~~
+
+Files which processes on a host share by mapping them into memory, along
+with a lock electing the one process which writes them.
+
+:copyright: (c) 2010 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+MAGIC = 'GRGS'
+FORMAT = 1
+
+# magic, format, generation, length of the data
+HEADER = struct.Struct('!4sIQQ')
+GENERATION = struct.Struct('!Q')
+GENERATION_OFFSET = 8
+
+
+def write_file(path, data):
+    """
+    Writes ``data`` to the file at ``path`` atomically, with a new generation,
+    which is returned.
+
+    The generation of the file it replaces is changed to the new one, so
+    processes which mapped it (see ``SharedFile``) know to map the new file.
+    """
+    try:
+        old_fd = os.open(path, os.O_RDWR)
+    except OSError:
+        old_fd = None
+    try:
+        generation = int(time.time() * 1000000)
+        replaces = False
+        if old_fd is not None:
+            header = os.read(old_fd, HEADER.size)
+            if len(header) == HEADER.size and header.startswith(MAGIC):
+                generation = max(generation, HEADER.unpack(header)[2] + 1)
+                replaces = True
+
+        fd, temp_path = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(HEADER.pack(MAGIC, FORMAT, generation, len(data)))
+                fp.write(data)
+            os.rename(temp_path, path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+        if replaces:
+            os.lseek(old_fd, GENERATION_OFFSET, os.SEEK_SET)
+            os.write(old_fd, GENERATION.pack(generation))
+    finally:
+        if old_fd is not None:
+            os.close(old_fd)
+    return generation
+
+
+def read_file(path):
+    """
+    Returns the data written to the file at ``path`` by ``write_file``.
+
+    Returns ``None`` if there is no such file, or it wasn't written by
+    ``write_file``.
+    """
+    try:
+        shared_file = SharedFile(path)
+    except (EnvironmentError, ValueError):
+        return None
+    try:
+        return shared_file.read()
+    finally:
+        shared_file.close()
+
+
+class SharedFile(object):
+    """
+    A file written by ``write_file``, mapped into memory read-only.
+
+    The pages of a mapped file are shared by every process which maps it, so
+    ``is_current`` is a read from memory rather than a system call.
+
+    Raises ``EnvironmentError`` if the file can't be opened, or ``ValueError``
+    if it wasn't written by ``write_file``.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            # raises ValueError if the file is empty
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < HEADER.size:
+            self.close()
+            raise ValueError('Invalid shared file %r' % (path,))
+        magic, format, self.generation, self.length = HEADER.unpack_from(self._map)
+        if magic != MAGIC or format != FORMAT or HEADER.size + self.length > len(self._map):
+            self.close()
+            raise ValueError('Invalid shared file %r' % (path,))
+
+    def is_current(self):
+        """
+        Returns ``False`` if the file has been replaced since it was mapped.
+        """
+        return GENERATION.unpack_from(self._map, GENERATION_OFFSET)[0] == self.generation
+
+    def read(self):
+        return self._map[HEADER.size:HEADER.size + self.length]
+
+    def close(self):
+        self._map.close()
+
+
+class HostLock(object):
+    """
+    An exclusive lock on the file at ``path``, held by at most one process on
+    the host, until it releases it or exits.
+
+    Unlike ``flock``, ``lockf`` locks belong to a process, so processes forked
+    from the one holding the lock don't hold it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._fp = None
+        self._pid = None
+
+    def is_held(self):
+        """
+        Returns ``True`` if this process holds the lock.
+        """
+        return self._pid == os.getpid()
+
+    def acquire(self):
+        """
+        Returns ``True`` if this process holds the lock, trying to take it
+        if it doesn't.
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return True
+        try:
+            if self._fp is None:
+                self._fp = open(self.path, 'a')
+            fcntl.lockf(self._fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except EnvironmentError:
+            # held by another process, or the file can't be opened
+            return False
+        self._pid = pid
+        return True
+
+    def release(self):
+        if self.is_held():
+            fcntl.lockf(self._fp, fcntl.LOCK_UN)
+        self._pid = None
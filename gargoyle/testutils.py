@@ -35,6 +35,7 @@ class SwitchContextManager(object):
     def __init__(self, gargoyle=gargoyle, **keys):
         self.gargoyle = gargoyle
         self.is_active_func = gargoyle.is_active
+        self.is_active_many_func = gargoyle.is_active_many
         self.keys = keys
         self._state = {}
         self._values = {
@@ -62,12 +63,41 @@ class SwitchContextManager(object):
             def wrapped(key, *args, **kwargs):
                 if key in self.keys:
                     return self.keys[key]
+                elif self._has_patched_parent(key):
+                    return gargoyle._is_active_recursive(key, *args, **kwargs)
                 return is_active_func(key, *args, **kwargs)
             return wrapped
 
+        def is_active_many(gargoyle):
+            is_active_many_func = gargoyle.is_active_many
+
+            def wrapped(keys, *args, **kwargs):
+                results = {}
+                remaining = []
+                for key in keys:
+                    if key in self.keys:
+                        results[key] = self.keys[key]
+                    elif self._has_patched_parent(key):
+                        results[key] = gargoyle.is_active(key, *args, **kwargs)
+                    else:
+                        remaining.append(key)
+                if remaining:
+                    results.update(is_active_many_func(remaining, *args, **kwargs))
+                return results
+            return wrapped
+
         self.gargoyle.is_active = is_active(self.gargoyle)
+        self.gargoyle.is_active_many = is_active_many(self.gargoyle)
+        # decisions memoized so far did not see the overrides
+        self.gargoyle.clear_request_cache()
 
     def unpatch(self):
         self.gargoyle.is_active = self.is_active_func
+        self.gargoyle.is_active_many = self.is_active_many_func
+        self.gargoyle.clear_request_cache()
+
+    def _has_patched_parent(self, key):
+        parts = key.split(':')
+        return any(':'.join(parts[:i]) in self.keys for i in range(1, len(parts)))
 
 switches = SwitchContextManager
@@ -15,7 +15,7 @@ tests_require = [
 ]
 
 install_requires = [
-    'django-modeldict>=1.2.0',
+    'django-modeldict>=1.4.1',
     'nexus>=0.2.3',
     'django-jsonfield>=0.9.2,<0.9.13',
 ]
@@ -4,32 +4,61 @@
 """
 
 import datetime
+import itertools
+import json
+import os
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+from StringIO import StringIO
 
 from django.conf import settings
 from django.contrib.auth.models import User, AnonymousUser
-from django.core.cache import cache
+from django.core.cache import cache, get_cache
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management.base import CommandError
+from django.core.validators import ValidationError
+from django.db import connection
 from django.core.management import call_command
 from django.http import HttpRequest, Http404, HttpResponse
 from django.test import TestCase
+from django.utils.functional import SimpleLazyObject
 from django.template import Context, Template, TemplateSyntaxError
 
 import gargoyle
-from gargoyle.builtins import IPAddressConditionSet, UserConditionSet, HostConditionSet
+from gargoyle import backends, compact, refresher as refresher_module
+from gargoyle.backends import CacheBackend, FileBackend, MemoryBackend, get_backend
+from gargoyle.builtins import IPAddressConditionSet, UserConditionSet, HostConditionSet, IPNetwork
+from gargoyle.chunked import get_chunked, get_chunk_keys, set_chunked
+from gargoyle.compact import CompactSwitch
+from gargoyle.compiler import uses_compiled_conditions
+from gargoyle.conditions import ConditionSet, EnvironmentConditionSet, ConditionMatcher, String, Range, Percent, BeforeDate, \
+    OnOrAfterDate
 from gargoyle.decorators import switch_is_active
 from gargoyle.helpers import MockRequest
-from gargoyle.models import Switch, SELECTIVE, DISABLED, GLOBAL, INHERIT
+from gargoyle.models import Switch, DeletedSwitch, SELECTIVE, DISABLED, GLOBAL, INHERIT
 from gargoyle.management.commands.add_switch import Command as AddSwitchCmd
+from gargoyle.management.commands.warm_switches import get_memory_usage
 from gargoyle.management.commands.remove_switch import (
     Command as RemoveSwitchCmd
 )
 from gargoyle.manager import SwitchManager
+from gargoyle.middleware import SwitchCacheMiddleware
+from gargoyle.networks import PrefixSet, parse_ip, parse_network
+from gargoyle.shared import HostLock, SharedFile, read_file, write_file
 from gargoyle.testutils import switches
 
 import socket
 
 
+class AllIPs(list):
+    def __contains__(self, ip):
+        return True
+
+
 class APITest(TestCase):
     urls = 'tests.urls'
 
@@ -483,6 +512,52 @@ class APITest(TestCase):
 
         self.assertFalse(self.gargoyle.is_active('test', request))
 
+        settings.INTERNAL_IPS = ['10.0.0.1', '192.168.0.0/16', '2001:db8::/32']
+
+        self.assertTrue(self.gargoyle.is_active('test', request))
+        self.assertTrue(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='2001:db8::1')))
+        self.assertFalse(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='10.0.0.2')))
+
+        # containers with their own __contains__ are left to decide
+        settings.INTERNAL_IPS = AllIPs(['10.0.0.1'])
+
+        self.assertTrue(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='8.8.8.8')))
+
+    def test_ip_network(self):
+        condition_set = 'gargoyle.builtins.IPAddressConditionSet'
+
+        Switch.objects.create(
+            key='test',
+            status=SELECTIVE,
+        )
+        switch = self.gargoyle['test']
+
+        switch.add_condition(
+            condition_set=condition_set,
+            field_name='ip_network',
+            condition='10.0.0.0/8',
+        )
+        switch.add_condition(
+            condition_set=condition_set,
+            field_name='ip_network',
+            condition='2001:db8::/32',
+        )
+
+        self.assertTrue(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='10.2.3.4')))
+        self.assertTrue(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='2001:db8:1::1')))
+        self.assertFalse(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='11.0.0.1')))
+        self.assertFalse(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='2001:db9::1')))
+
+        switch.add_condition(
+            condition_set=condition_set,
+            field_name='ip_network',
+            condition='10.1.0.0/16',
+            exclude=True,
+        )
+
+        self.assertTrue(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='10.2.3.4')))
+        self.assertFalse(self.gargoyle.is_active('test', self.gargoyle.as_request(ip_address='10.1.3.4')))
+
     def test_ip_address(self):
         condition_set = 'gargoyle.builtins.IPAddressConditionSet'
 
@@ -868,6 +943,1554 @@ class APITest(TestCase):
         self.assertFalse(self.gargoyle.is_active('test:child'))
 
 
+class CompiledPlanTest(TestCase):
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True)
+        self.gargoyle.register(UserConditionSet(User))
+
+    def test_plans_are_reused(self):
+        Switch.objects.create(key='test', status=GLOBAL)
+
+        self.assertTrue(self.gargoyle.is_active('test'))
+        plan = self.gargoyle._get_plan('test')
+        self.assertTrue(self.gargoyle.is_active('test'))
+        self.assertTrue(self.gargoyle._get_plan('test') is plan)
+
+        self.gargoyle.register(IPAddressConditionSet())
+        self.assertFalse(self.gargoyle._get_plan('test') is plan)
+
+        plan = self.gargoyle._get_plan('test')
+        switch = self.gargoyle['test']
+        switch.status = DISABLED
+        switch.save()
+        self.assertFalse(self.gargoyle._get_plan('test') is plan)
+        self.assertFalse(self.gargoyle.is_active('test'))
+
+    def test_plan_only_includes_condition_sets_in_use(self):
+        condition_set = 'gargoyle.builtins.UserConditionSet(auth.user)'
+        self.gargoyle.register(IPAddressConditionSet())
+
+        Switch.objects.create(key='test', status=SELECTIVE)
+        switch = self.gargoyle['test']
+        switch.add_condition(
+            condition_set=condition_set,
+            field_name='username',
+            condition='bob',
+        )
+
+        plan = self.gargoyle._get_plan('test')
+        self.assertEquals(len(plan.conditions), 1)
+        self.assertEquals(plan.conditions[0][1].keys(), ['username'])
+
+    def test_only_condition_sets_in_namespace_are_visited(self):
+        class UnusedConditionSet(ConditionSet):
+            name = String()
+
+            def compile(self, conditions):
+                raise AssertionError('should not be compiled')
+
+        self.gargoyle.register(UnusedConditionSet())
+        self.assertEquals(self.gargoyle._index.namespaces['UnusedConditionSet'], [
+            self.gargoyle.get_condition_set_by_id('tests.tests.UnusedConditionSet'),
+        ])
+
+        Switch.objects.create(key='test', status=SELECTIVE)
+        switch = self.gargoyle['test']
+        switch.add_condition(
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='bob',
+        )
+
+        self.assertTrue(self.gargoyle.is_active('test', User(username='bob')))
+
+        self.gargoyle.unregister(UnusedConditionSet())
+        self.assertFalse('UnusedConditionSet' in self.gargoyle._index.namespaces)
+
+    def test_condition_sets_are_dispatched_by_type(self):
+        user_condition_set = self.gargoyle.get_condition_set_by_id('gargoyle.builtins.UserConditionSet(auth.user)')
+        self.assertEquals(self.gargoyle._index.get_condition_sets_for(User()), (user_condition_set,))
+        self.assertEquals(self.gargoyle._index.get_condition_sets_for(HttpRequest()), ())
+
+        calls = []
+
+        class OddConditionSet(ConditionSet):
+            percent = Percent()
+
+            def can_execute(self, instance):
+                calls.append(instance)
+                return isinstance(instance, int) and instance % 2
+
+            def get_field_value(self, instance, field_name):
+                return instance
+
+        self.gargoyle.register(IPAddressConditionSet())
+        self.gargoyle.register(OddConditionSet())
+        ip_condition_set = self.gargoyle.get_condition_set_by_id('gargoyle.builtins.IPAddressConditionSet')
+        odd_condition_set = self.gargoyle.get_condition_set_by_id('tests.tests.OddConditionSet')
+        self.assertEquals(self.gargoyle._index.get_condition_sets_for(HttpRequest()), (ip_condition_set,))
+        self.assertEquals(self.gargoyle._index.get_condition_sets_for(3), (odd_condition_set,))
+        self.assertEquals(self.gargoyle._index.get_condition_sets_for(4), ())
+
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.gargoyle['test'].add_condition(
+            condition_set='tests.tests.OddConditionSet',
+            field_name='percent',
+            condition='0-50',
+        )
+
+        del calls[:]
+        self.assertTrue(self.gargoyle.is_active('test', 3))
+        self.assertFalse(self.gargoyle.is_active('test', 4))
+        self.assertFalse(self.gargoyle.is_active('test', 53))
+        user = User(username='bob')
+        self.assertFalse(self.gargoyle.is_active('test', user))
+        # only ConditionSets which may depend on more than the type are asked
+        self.assertEquals(calls, [3, None, 4, None, 53, None, user, None])
+
+        self.gargoyle.unregister(OddConditionSet())
+        self.assertEquals(self.gargoyle._index.get_condition_sets_for(3), ())
+
+    def test_snapshots_are_replaced(self):
+        Switch.objects.create(key='test', status=GLOBAL)
+        snapshot = self.gargoyle._get_snapshot()
+        self.assertTrue(self.gargoyle._get_snapshot() is snapshot)
+        self.assertRaises(AttributeError, setattr, snapshot, 'plans', {})
+
+        switch = self.gargoyle['test']
+        switch.status = DISABLED
+        switch.save()
+
+        self.assertFalse(self.gargoyle._get_snapshot() is snapshot)
+        self.assertFalse(self.gargoyle.is_active('test'))
+        self.assertEquals(snapshot.constants, {'test': True})
+
+    def test_unsaved_changes_are_used(self):
+        Switch.objects.create(key='test', status=GLOBAL)
+        self.assertTrue(self.gargoyle.is_active('test'))
+
+        switch = self.gargoyle['test']
+        switch.status = DISABLED
+        self.assertFalse(self.gargoyle.is_active('test'))
+
+    def test_parents_are_linked(self):
+        Switch.objects.create(key='a', status=GLOBAL)
+        Switch.objects.create(key='a:b:c', status=INHERIT)
+        Switch.objects.create(key='a:b:c:d', status=INHERIT)
+        Switch.objects.create(key='off', status=DISABLED)
+        Switch.objects.create(key='off:on', status=GLOBAL)
+        Switch.objects.create(key='selective', status=SELECTIVE)
+        self.gargoyle['selective'].add_condition(
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='bob',
+        )
+        Switch.objects.create(key='selective:child', status=INHERIT)
+
+        plan = self.gargoyle._get_plan('a:b:c:d')
+        self.assertFalse(plan.dynamic)
+        self.assertTrue(plan.constant)
+
+        plan = self.gargoyle._get_plan('off:on')
+        self.assertFalse(plan.dynamic)
+        self.assertFalse(plan.constant)
+
+        plan = self.gargoyle._get_plan('selective:child')
+        self.assertTrue(plan.dynamic)
+        self.assertEquals(plan.ancestors, (self.gargoyle._get_plan('selective'),))
+        self.assertTrue(self.gargoyle.is_active('selective:child', User(username='bob')))
+        self.assertFalse(self.gargoyle.is_active('selective:child', User(username='joe')))
+
+    def test_constant_switches_skip_evaluation(self):
+        Switch.objects.create(key='on', status=GLOBAL)
+        Switch.objects.create(key='off', status=DISABLED)
+        Switch.objects.create(key='inherit', status=INHERIT)
+        Switch.objects.create(key='selective', status=SELECTIVE)
+        self.gargoyle['selective'].add_condition(
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='bob',
+        )
+
+        plans, constants = self.gargoyle._get_compiled()
+        self.assertEquals(constants, {'on': True, 'off': False, 'inherit': None})
+
+        def check(*args, **kwargs):
+            raise AssertionError('should not be evaluated')
+        self.gargoyle._check = check
+
+        self.assertTrue(self.gargoyle.is_active('on', User(username='bob')))
+        self.assertFalse(self.gargoyle.is_active('off'))
+        self.assertFalse(self.gargoyle.is_active('inherit'))
+        self.assertTrue(self.gargoyle.is_active('inherit', default=True))
+        self.assertRaises(AssertionError, self.gargoyle.is_active, 'selective')
+
+    def test_request_user_is_only_loaded_when_needed(self):
+        self.gargoyle.register(IPAddressConditionSet())
+        loaded = []
+
+        def get_user():
+            loaded.append(True)
+            return User(username='bob')
+
+        request = HttpRequest()
+        request.META['REMOTE_ADDR'] = '192.168.1.1'
+        request.user = SimpleLazyObject(get_user)
+
+        Switch.objects.create(key='ip', status=SELECTIVE)
+        self.gargoyle['ip'].add_condition(
+            condition_set='gargoyle.builtins.IPAddressConditionSet',
+            field_name='ip_address',
+            condition='192.168.1.1',
+        )
+        self.assertFalse(self.gargoyle._get_plan('ip').uses_user)
+        self.assertTrue(self.gargoyle.is_active('ip', request))
+        self.assertEquals(loaded, [])
+
+        Switch.objects.create(key='user', status=SELECTIVE)
+        self.gargoyle['user'].add_condition(
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='bob',
+        )
+        self.assertTrue(self.gargoyle._get_plan('user').uses_user)
+        self.assertTrue(self.gargoyle.is_active('user', request))
+        self.assertEquals(loaded, [True])
+
+    def test_linked_parents_match_recursive_lookups(self):
+        self.gargoyle.auto_create = False
+        statuses = [None, DISABLED, GLOBAL, INHERIT, SELECTIVE]
+        keys = ['a', 'a:b', 'a:b:c']
+        users = [User(username='bob'), User(username='joe')]
+
+        for combination in itertools.product(statuses, repeat=len(keys)):
+            Switch.objects.all().delete()
+            Switch.objects.bulk_create([
+                Switch(key=key, status=status, value=(
+                    {'auth.user': {'username': [['i', 'bob']]}} if status == SELECTIVE else {}
+                ))
+                for key, status in zip(keys, combination)
+                if status is not None
+            ])
+            self.gargoyle._populate(reset=True)
+
+            for key in keys + ['a:b:c:missing']:
+                for default in (False, True, None):
+                    for user in users:
+                        self.assertEquals(
+                            self.gargoyle.is_active(key, user, default=default),
+                            self.gargoyle._is_active_recursive(key, user, default=default),
+                            (combination, key, default, user.username),
+                        )
+
+    def test_legacy_condition_set(self):
+        class LegacyConditionSet(ConditionSet):
+            name = String()
+
+            def is_active(self, instance, conditions):
+                return bool(conditions.get(self.get_namespace()))
+
+        self.gargoyle.register(LegacyConditionSet())
+
+        Switch.objects.create(key='test', status=SELECTIVE)
+        switch = self.gargoyle['test']
+        switch.add_condition(
+            condition_set='tests.tests.LegacyConditionSet',
+            field_name='name',
+            condition='anything',
+        )
+
+        self.assertTrue(self.gargoyle.is_active('test'))
+
+    def test_user_condition_set_fields(self):
+        # hidden by UserConditionSet.is_active, as it always was
+        self.assertFalse('is_active' in UserConditionSet.fields)
+        self.assertTrue('is_staff' in UserConditionSet.fields)
+        self.assertTrue(uses_compiled_conditions(UserConditionSet(User)))
+
+    def test_overridden_user_condition_set(self):
+        class StaffOnlyConditionSet(UserConditionSet):
+            def is_active(self, instance, conditions):
+                if isinstance(instance, User) and not instance.is_staff:
+                    return False
+                return super(StaffOnlyConditionSet, self).is_active(instance, conditions)
+
+        condition_set = StaffOnlyConditionSet(User)
+        gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True)
+        gargoyle.register(condition_set)
+
+        Switch.objects.create(key='test', status=SELECTIVE)
+        gargoyle['test'].add_condition(
+            condition_set=condition_set.get_id(),
+            field_name='username',
+            condition='bob',
+        )
+
+        bob = User(username='bob')
+        self.assertFalse(condition_set.has_active_condition(gargoyle['test'].value, [bob]))
+        self.assertFalse(gargoyle.is_active('test', bob))
+        bob.is_staff = True
+        self.assertTrue(gargoyle.is_active('test', bob))
+
+
+class IsActiveManyTest(TestCase):
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=False)
+        self.gargoyle.register(UserConditionSet(User))
+        self.gargoyle.register(IPAddressConditionSet())
+
+    def add_username_switch(self, key, username):
+        Switch.objects.create(key=key, status=SELECTIVE)
+        self.gargoyle[key].add_condition(
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition=username,
+        )
+
+    def test_matches_is_active(self):
+        Switch.objects.create(key='global', status=GLOBAL)
+        Switch.objects.create(key='disabled', status=DISABLED)
+        Switch.objects.create(key='global:child', status=INHERIT)
+        Switch.objects.create(key='disabled:child', status=GLOBAL)
+        self.add_username_switch('bob', 'bob')
+        self.add_username_switch('joe', 'joe')
+        self.add_username_switch('bob:child', 'joe')
+
+        keys = ['global', 'disabled', 'global:child', 'disabled:child', 'bob', 'joe', 'bob:child', 'missing']
+        request = self.gargoyle.as_request(user=User(username='bob'), ip_address='127.0.0.1')
+
+        result = self.gargoyle.is_active_many(keys, request)
+        self.assertEquals(result, dict((k, self.gargoyle.is_active(k, request)) for k in keys))
+        self.assertEquals(result, {
+            'global': True,
+            'disabled': False,
+            'global:child': True,
+            'disabled:child': False,
+            'bob': True,
+            'joe': False,
+            'bob:child': False,
+            'missing': False,
+        })
+
+        self.assertEquals(self.gargoyle.is_active_many(['missing'], default=True), {'missing': True})
+
+    def test_field_values_are_shared(self):
+        lookups = []
+
+        class CountingConditionSet(UserConditionSet):
+            def get_field_value(self, instance, field_name):
+                lookups.append(field_name)
+                return super(CountingConditionSet, self).get_field_value(instance, field_name)
+
+        self.gargoyle.unregister(UserConditionSet(User))
+        self.gargoyle.register(CountingConditionSet(User))
+
+        condition_set = 'tests.tests.CountingConditionSet(auth.user)'
+        for key in ('a', 'b', 'c'):
+            Switch.objects.create(key=key, status=SELECTIVE)
+            self.gargoyle[key].add_condition(
+                condition_set=condition_set,
+                field_name='username',
+                condition=key,
+            )
+
+        result = self.gargoyle.is_active_many(['a', 'b', 'c'], User(username='b'))
+        self.assertEquals(result, {'a': False, 'b': True, 'c': False})
+        self.assertEquals(lookups, ['username'])
+
+    def test_switches_override(self):
+        Switch.objects.create(key='test', status=GLOBAL)
+        Switch.objects.create(key='test:child', status=GLOBAL)
+        Switch.objects.create(key='other', status=DISABLED)
+
+        with switches(self.gargoyle, test=False, other=True):
+            self.assertEquals(self.gargoyle.is_active_many(['test', 'test:child', 'other']), {
+                'test': False,
+                'test:child': False,
+                'other': True,
+            })
+
+        self.assertEquals(self.gargoyle.is_active_many(['test', 'test:child', 'other']), {
+            'test': True,
+            'test:child': True,
+            'other': False,
+        })
+
+
+class RequestCacheTest(TestCase):
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True)
+        self.gargoyle.register(UserConditionSet(User))
+        self.bob = User(username='bob')
+        Switch.objects.create(key='test', status=SELECTIVE)
+        self.gargoyle['test'].add_condition(
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='bob',
+        )
+
+    def tearDown(self):
+        self.gargoyle.disable_request_cache()
+
+    def change_behind_the_scenes(self, key):
+        # change the switch without sending signals, and reload it
+        Switch.objects.filter(key=key).update(value={'auth.user': {'username': [['i', 'joe']]}})
+        self.gargoyle._populate(reset=True)
+
+    def test_decisions_are_memoized(self):
+        self.gargoyle.enable_request_cache()
+        self.assertTrue(self.gargoyle.is_active('test', self.bob))
+
+        self.change_behind_the_scenes('test')
+        self.assertTrue(self.gargoyle.is_active('test', self.bob))
+
+        self.gargoyle.disable_request_cache()
+        self.assertFalse(self.gargoyle.is_active('test', self.bob))
+
+    def test_decisions_are_keyed_by_instances(self):
+        condition_set = 'gargoyle.builtins.UserConditionSet(auth.user)'
+        Switch.objects.create(key='selective', status=SELECTIVE)
+        switch = self.gargoyle['selective']
+        switch.add_condition(
+            condition_set=condition_set,
+            field_name='username',
+            condition='bob',
+        )
+
+        self.gargoyle.enable_request_cache()
+        bob, joe = User(username='bob'), User(username='joe')
+        self.assertTrue(self.gargoyle.is_active('selective', bob))
+        self.assertFalse(self.gargoyle.is_active('selective', joe))
+        self.assertFalse(self.gargoyle.is_active('selective'))
+        self.assertTrue(self.gargoyle.is_active('selective', bob))
+
+    def test_decisions_are_keyed_by_request_user(self):
+        request = HttpRequest()
+        request.user = SimpleLazyObject(lambda: AnonymousUser())
+        self.gargoyle.enable_request_cache()
+        self.assertFalse(self.gargoyle.is_active('test', request))
+
+        # as auth.login does
+        request.user = self.bob
+        self.assertTrue(self.gargoyle.is_active('test', request))
+        self.assertEquals(self.gargoyle.is_active_many(['test'], request), {'test': True})
+
+        # and logout
+        request.user = AnonymousUser()
+        self.assertFalse(self.gargoyle.is_active('test', request))
+
+    def test_field_values_are_cached(self):
+        lookups = []
+
+        class CountingConditionSet(IPAddressConditionSet):
+            def get_field_value(self, instance, field_name):
+                lookups.append(field_name)
+                return super(CountingConditionSet, self).get_field_value(instance, field_name)
+
+        self.gargoyle.register(CountingConditionSet())
+        for key, condition in (('first', '0-50'), ('second', '50-100')):
+            Switch.objects.create(key=key, status=SELECTIVE)
+            self.gargoyle[key].add_condition(
+                condition_set='tests.tests.CountingConditionSet',
+                field_name='percent',
+                condition=condition,
+            )
+
+        request = self.gargoyle.as_request(ip_address='192.168.1.1')
+        self.assertFalse(self.gargoyle.is_active('first', request))
+        self.assertTrue(self.gargoyle.is_active('second', request))
+        self.assertEquals(lookups, ['percent', 'percent'])
+
+        del lookups[:]
+        self.gargoyle.enable_request_cache()
+        self.assertFalse(self.gargoyle.is_active('first', request))
+        self.assertTrue(self.gargoyle.is_active('second', request))
+        self.assertEquals(lookups, ['percent'])
+
+    def test_snapshot_is_pinned(self):
+        Switch.objects.create(key='on', status=GLOBAL)
+
+        self.gargoyle.enable_request_cache()
+        self.assertTrue(self.gargoyle.is_active('on'))
+        self.assertTrue(self.gargoyle.is_active('test', self.bob))
+
+        # another process disables the switch, and changes the conditions
+        Switch.objects.filter(key='on').update(status=DISABLED)
+        self.change_behind_the_scenes('test')
+
+        self.assertTrue(self.gargoyle.is_active('on'))
+        self.assertEquals(self.gargoyle.is_active_many(['on', 'test'], self.bob), {'on': True, 'test': True})
+
+        self.gargoyle.disable_request_cache()
+        self.assertFalse(self.gargoyle.is_active('on'))
+        self.assertFalse(self.gargoyle.is_active('test', self.bob))
+
+    def test_saving_clears_decisions(self):
+        self.gargoyle.enable_request_cache()
+        self.assertTrue(self.gargoyle.is_active('test', self.bob))
+
+        switch = self.gargoyle['test']
+        switch.clear_conditions(condition_set='gargoyle.builtins.UserConditionSet(auth.user)')
+        switch.add_condition(
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='joe',
+        )
+        self.assertFalse(self.gargoyle.is_active('test', self.bob))
+
+    def test_middleware(self):
+        import gargoyle.middleware
+
+        old_gargoyle = gargoyle.middleware.gargoyle
+        gargoyle.middleware.gargoyle = self.gargoyle
+        try:
+            middleware = SwitchCacheMiddleware()
+            request = HttpRequest()
+            request.user = self.bob
+
+            middleware.process_request(request)
+            self.assertTrue(self.gargoyle.is_active('test', request))
+            self.change_behind_the_scenes('test')
+            self.assertTrue(self.gargoyle.is_active('test', request))
+
+            response = HttpResponse()
+            self.assertTrue(middleware.process_response(request, response) is response)
+            self.assertFalse(self.gargoyle.is_active('test', request))
+        finally:
+            gargoyle.middleware.gargoyle = old_gargoyle
+
+    def test_switches_override(self):
+        Switch.objects.create(key='test:child', status=GLOBAL)
+
+        self.gargoyle.enable_request_cache()
+        self.assertTrue(self.gargoyle.is_active('test:child', self.bob))
+
+        with switches(self.gargoyle, test=False):
+            self.assertFalse(self.gargoyle.is_active('test', self.bob))
+            self.assertFalse(self.gargoyle.is_active('test:child', self.bob))
+
+        self.assertTrue(self.gargoyle.is_active('test', self.bob))
+        self.assertTrue(self.gargoyle.is_active('test:child', self.bob))
+
+
+class PrefixSetTest(TestCase):
+    def test_contains(self):
+        networks = PrefixSet(['10.0.0.0/8', '192.168.1.1', '0.0.0.0/32', '2001:db8::/32', '::1'])
+        self.assertEquals(len(networks), 5)
+        self.assertTrue(parse_ip('10.255.0.1') in networks)
+        self.assertTrue(parse_ip('192.168.1.1') in networks)
+        self.assertTrue(parse_ip('0.0.0.0') in networks)
+        self.assertTrue(parse_ip('2001:db8:ffff::1') in networks)
+        self.assertTrue(parse_ip('::1') in networks)
+        self.assertFalse(parse_ip('11.0.0.1') in networks)
+        self.assertFalse(parse_ip('192.168.1.2') in networks)
+        self.assertFalse(parse_ip('::2') in networks)
+        # IPv4 networks don't contain IPv6 addresses of the same value
+        self.assertFalse(parse_ip('::a00:1') in networks)
+
+    def test_everything(self):
+        networks = PrefixSet(['0.0.0.0/0'])
+        self.assertTrue(parse_ip('255.255.255.255') in networks)
+        self.assertFalse(parse_ip('::') in networks)
+
+    def test_invalid(self):
+        for value in ('', '10.0.0', '10.0.0.256', '10.0.0.0/33', '10.0.0.0/', '10.0.0.0/-1', '::1/129', 'foo', None):
+            self.assertRaises(ValueError, parse_network, value)
+        for value in ('', '10.0.0.0/8', '1', None):
+            self.assertRaises(ValueError, parse_ip, value)
+
+
+class RecordingCache(object):
+    def __init__(self, cache):
+        self.cache = cache
+        self.gets = []
+        self.adds = []
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+    def get(self, key, *args, **kwargs):
+        self.gets.append(key)
+        return self.cache.get(key, *args, **kwargs)
+
+    def get_many(self, keys, *args, **kwargs):
+        self.gets.append(tuple(keys))
+        return self.cache.get_many(keys, *args, **kwargs)
+
+    def add(self, key, *args, **kwargs):
+        self.adds.append(key)
+        return self.cache.add(key, *args, **kwargs)
+
+
+class SlowCache(object):
+    # widens the window between reading and writing a key
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+    def get(self, key, *args, **kwargs):
+        value = self.cache.get(key, *args, **kwargs)
+        time.sleep(0.01)
+        return value
+
+
+class SwitchManagerTestMixin(object):
+    """
+    Creates managers as separate processes would, with ``manager_options``,
+    and changes switches behind their backs.
+    """
+    manager_options = {}
+
+    def get_manager(self, **kwargs):
+        options = dict({'auto_create': True, 'cache': RecordingCache(cache)}, **self.manager_options)
+        options.update(kwargs)
+        manager = SwitchManager(Switch, key='key', value='value', instances=True, **options)
+        manager.register(UserConditionSet(User))
+        self.addCleanup(manager.stop_refresher)
+        return manager
+
+    def change_behind_the_scenes(self, key, manager=None, **changes):
+        # as if another process changed the switch, without sending signals
+        manager = manager or self.gargoyle
+        changes.setdefault('date_modified', datetime.datetime.now())
+        Switch.objects.filter(key=key).update(**changes)
+        cache.incr(manager.remote_cache_version_key)
+        manager._cleanup()
+
+
+class ChunkedTest(TestCase):
+    def setUp(self):
+        self.value = dict(('switch%d' % i, {'ip': {'ip_address': [['i', '10.0.%d.%d' % (i // 256, i % 256)]]}})
+                          for i in xrange(2000))
+
+    def test_round_trip(self):
+        set_chunked(cache, 'chunked', self.value, chunk_size=1024)
+        manifest = cache.get('chunked')
+        self.assertTrue(manifest['chunks'] > 1)
+        self.assertEquals(get_chunked(cache, 'chunked'), self.value)
+
+        set_chunked(cache, 'chunked', {'small': 1}, chunk_size=1024, tag=2)
+        self.assertEquals(cache.get('chunked')['chunks'], 1)
+        self.assertEquals(get_chunked(cache, 'chunked', tag=2), {'small': 1})
+        self.assertEquals(get_chunked(cache, 'chunked', tag=1), None)
+
+    def test_replaced_chunks_are_deleted(self):
+        set_chunked(cache, 'chunked', self.value, chunk_size=1024)
+        old_keys = get_chunk_keys('chunked', cache.get('chunked'))
+        set_chunked(cache, 'chunked', self.value, chunk_size=1024, tag=2)
+        # the same value, stored under the same chunks
+        self.assertEquals(len(cache.get_many(old_keys)), len(old_keys))
+
+        set_chunked(cache, 'chunked', {'small': 1}, chunk_size=1024, tag=3)
+        self.assertEquals(cache.get_many(old_keys), {})
+        self.assertEquals(get_chunked(cache, 'chunked', tag=3), {'small': 1})
+
+    def test_missing(self):
+        self.assertEquals(get_chunked(cache, 'chunked'), None)
+        cache.set('chunked', 'not a manifest')
+        self.assertEquals(get_chunked(cache, 'chunked'), None)
+
+    def test_incomplete(self):
+        set_chunked(cache, 'chunked', self.value, chunk_size=1024)
+        cache.delete(get_chunk_keys('chunked', cache.get('chunked'))[-1])
+        self.assertEquals(get_chunked(cache, 'chunked'), None)
+
+    def test_corrupt(self):
+        set_chunked(cache, 'chunked', self.value, chunk_size=1024)
+        chunk_key = get_chunk_keys('chunked', cache.get('chunked'))[0]
+        chunk = cache.get(chunk_key)
+        cache.set(chunk_key, chunk[:-1] + chr(ord(chunk[-1]) ^ 1))
+        self.assertEquals(get_chunked(cache, 'chunked'), None)
+
+
+class VersionedCacheTest(SwitchManagerTestMixin, TestCase):
+    def setUp(self):
+        Switch.objects.create(key='test', status=GLOBAL)
+
+    def test_only_version_is_polled(self):
+        manager = self.get_manager()
+        self.assertTrue(manager.is_active('test'))
+
+        del manager.remote_cache.gets[:]
+        manager._cleanup()
+        self.assertTrue(manager.is_active('test'))
+        self.assertEquals(manager.remote_cache.gets, [manager.remote_cache_version_key])
+
+    def test_switches_are_fetched_when_version_changes(self):
+        manager = self.get_manager()
+        self.assertTrue(manager.is_active('test'))
+        version = cache.get(manager.remote_cache_version_key)
+
+        other = self.get_manager()
+        self.assertTrue(other.is_active('test'))
+
+        # another process changes the switch
+        Switch.objects.filter(key='test').update(status=DISABLED)
+        manager._bump_version()
+        self.assertTrue(cache.get(manager.remote_cache_version_key) > version)
+
+        del other.remote_cache.gets[:]
+        other._cleanup()
+        self.assertFalse(other.is_active('test'))
+        self.assertEquals(other.remote_cache.gets, [
+            other.remote_cache_version_key,
+            other.remote_cache_version_key,
+            other.remote_cache_key,
+            # the manifest replaced, to delete its chunks
+            other.remote_cache_key,
+            # released the reload lock
+            other.remote_cache_lock_key,
+        ])
+
+        # the switches were published for the new version
+        with self.assertNumQueries(0):
+            self.assertFalse(self.get_manager().is_active('test'))
+
+    def test_saving_bumps_version(self):
+        manager = self.get_manager()
+        self.assertTrue(manager.is_active('test'))
+        version = cache.get(manager.remote_cache_version_key)
+
+        switch = manager['test']
+        switch.status = DISABLED
+        switch.save()
+        self.assertTrue(cache.get(manager.remote_cache_version_key) > version)
+        version = cache.get(manager.remote_cache_version_key)
+
+        switch.delete()
+        self.assertTrue(cache.get(manager.remote_cache_version_key) > version)
+
+    def test_switches_are_chunked(self):
+        for i in xrange(50):
+            Switch.objects.create(key='switch%d' % i, status=GLOBAL,
+                                  value={'auth.user': {'username': [['i', os.urandom(50).encode('hex')]]}})
+        manager = self.get_manager()
+        manager.cache_chunk_size = 1024
+        manager._bump_version()
+        self.assertTrue(manager.is_active('test'))
+        manifest = cache.get(manager.remote_cache_key)
+        self.assertTrue(manifest['chunks'] > 1)
+
+        other = self.get_manager()
+        with self.assertNumQueries(0):
+            self.assertTrue(other.is_active('switch0'))
+        self.assertEquals(other.remote_cache.gets[-1], tuple(get_chunk_keys(manager.remote_cache_key, manifest)))
+
+    def test_old_switches_are_deleted(self):
+        manager = self.get_manager()
+        self.assertTrue(manager.is_active('test'))
+        manifest = cache.get(manager.remote_cache_key)
+
+        for status in (DISABLED, GLOBAL, DISABLED):
+            switch = manager['test']
+            switch.status = status
+            switch.save()
+            self.get_manager().is_active('test')
+            self.assertEquals(cache.get_many(get_chunk_keys(manager.remote_cache_key, manifest)), {})
+            manifest = cache.get(manager.remote_cache_key)
+            self.assertEquals(len(cache.get_many(get_chunk_keys(manager.remote_cache_key, manifest))), 1)
+
+    def test_switches_are_compact(self):
+        Switch.objects.filter(key='test').update(label='Test', description='A test')
+        manager = self.get_manager()
+        manager._bump_version()
+        self.assertTrue(manager.is_active('test'))
+
+        data = get_chunked(cache, manager.remote_cache_key, tag=cache.get(manager.remote_cache_version_key))
+        self.assertEquals(data['schema'], 1)
+        self.assertEquals(data['switches'], [('test', GLOBAL, {})])
+
+        other = self.get_manager()
+        with self.assertNumQueries(0):
+            self.assertTrue(other.is_active('test'))
+        self.assertTrue(isinstance(other._local_cache['test'], CompactSwitch))
+
+        # looking up the switch loads all of it
+        with self.assertNumQueries(1):
+            switch = other['test']
+        self.assertEquals(switch.label, 'Test')
+        self.assertEquals(switch.description, 'A test')
+        self.assertTrue(isinstance(other._local_cache['test'], Switch))
+
+        switch.status = DISABLED
+        self.assertFalse(other.is_active('test'))
+
+    def test_switches_are_hydrated(self):
+        Switch.objects.filter(key='test').update(label='Test')
+        Switch.objects.create(key='other', status=DISABLED, label='Other')
+        manager = self.get_manager()
+        manager._bump_version()
+        self.assertTrue(manager.is_active('test'))
+
+        other = self.get_manager()
+        with self.assertNumQueries(1):
+            self.assertEquals(other.get('test').label, 'Test')
+        self.assertEquals(other.get('missing'), None)
+
+        other = self.get_manager()
+        with self.assertNumQueries(1):
+            self.assertEquals(sorted(s.label for s in other.values()), ['Other', 'Test'])
+            self.assertEquals(sorted((k, s.label) for k, s in other.items()), [('other', 'Other'), ('test', 'Test')])
+            self.assertEquals(sorted(s.label for k, s in other.iteritems()), ['Other', 'Test'])
+        self.assertEquals(other.get('test').to_dict(other)['label'], 'Test')
+
+    def test_unknown_schema(self):
+        manager = self.get_manager()
+        self.assertTrue(manager.is_active('test'))
+        data = get_chunked(cache, manager.remote_cache_key, tag=cache.get(manager.remote_cache_version_key))
+        data['schema'] += 1
+        set_chunked(cache, manager.remote_cache_key, data, tag=cache.get(manager.remote_cache_version_key))
+
+        with self.assertNumQueries(1):
+            self.assertTrue(self.get_manager().is_active('test'))
+
+    def test_evicted_version(self):
+        manager = self.get_manager()
+        self.assertTrue(manager.is_active('test'))
+        version = cache.get(manager.remote_cache_version_key)
+
+        cache.delete(manager.remote_cache_version_key)
+        manager._bump_version()
+        self.assertTrue(cache.get(manager.remote_cache_version_key) > version)
+
+    def test_entries_do_not_expire(self):
+        expiring = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='expiring', TIMEOUT=1)
+        self.addCleanup(expiring.clear)
+        manager = self.get_manager(cache=expiring)
+        self.assertTrue(manager.is_active('test'))
+        version = expiring.get(manager.remote_cache_version_key)
+        self.assertEquals(manager.stats['reloads'], 1)
+
+        # outlive the default timeout of the cache
+        real_time = time.time
+        self.addCleanup(setattr, time, 'time', real_time)
+        time.time = lambda: real_time() + 2
+        manager._cleanup()
+        self.assertTrue(manager.is_active('test'))
+        self.assertEquals(expiring.get(manager.remote_cache_version_key), version)
+        self.assertEquals(manager.stats['reloads'], 1)
+
+        with self.assertNumQueries(0):
+            self.assertTrue(self.get_manager(cache=expiring).is_active('test'))
+
+
+class StampedeTest(SwitchManagerTestMixin, TestCase):
+    def setUp(self):
+        Switch.objects.create(key='test', status=GLOBAL)
+        self.gargoyle = self.get_manager()
+        self.assertTrue(self.gargoyle.is_active('test'))
+        self.gargoyle.stats.clear()
+
+    def tearDown(self):
+        cache.delete(self.gargoyle.remote_cache_lock_key)
+
+    def get_manager(self, **kwargs):
+        manager = super(StampedeTest, self).get_manager(**kwargs)
+        manager.reload_wait = 0.2
+        manager.reload_poll_interval = 0.01
+        return manager
+
+    def reload_elsewhere(self):
+        # as if another process changed the switch, and is reloading them
+        cache.add(self.gargoyle.remote_cache_lock_key, 'other')
+        self.change_behind_the_scenes('test', status=DISABLED)
+
+    def test_stale_switches_are_kept_while_reloading(self):
+        self.reload_elsewhere()
+        with self.assertNumQueries(0):
+            self.assertTrue(self.gargoyle.is_active('test'))
+        self.assertEquals(self.gargoyle.stats['stale_hits'], 1)
+
+        # the other process is done
+        other = self.get_manager()
+        other._populate(reset=True)
+        cache.delete(self.gargoyle.remote_cache_lock_key)
+
+        # not checked again right away
+        self.assertTrue(self.gargoyle.is_active('test'))
+        self.gargoyle._last_checked_for_remote_changes -= self.gargoyle.stale_recheck_interval
+        with self.assertNumQueries(0):
+            self.assertFalse(self.gargoyle.is_active('test'))
+        self.assertEquals(self.gargoyle.stats['cache_hits'], 1)
+        self.assertEquals(self.gargoyle.stats['reloads'], 0)
+
+    def test_stale_checks_are_throttled(self):
+        self.reload_elsewhere()
+        self.assertTrue(self.gargoyle.is_active('test'))
+
+        remote_cache = self.gargoyle.remote_cache
+        del remote_cache.gets[:]
+        del remote_cache.adds[:]
+        for i in xrange(10):
+            self.assertTrue(self.gargoyle.is_active('test'))
+        self.assertEquals(remote_cache.gets, [])
+        self.assertEquals(remote_cache.adds, [])
+
+        self.gargoyle._last_checked_for_remote_changes -= self.gargoyle.stale_recheck_interval
+        for i in xrange(10):
+            self.assertTrue(self.gargoyle.is_active('test'))
+        self.assertEquals(remote_cache.gets, [
+            self.gargoyle.remote_cache_version_key,
+            self.gargoyle.remote_cache_version_key,
+            self.gargoyle.remote_cache_key,
+        ])
+        self.assertEquals(remote_cache.adds, [self.gargoyle.remote_cache_lock_key])
+        self.assertEquals(self.gargoyle.stats['stale_hits'], 2)
+
+    def test_stale_switches_expire(self):
+        self.reload_elsewhere()
+        self.assertTrue(self.gargoyle.is_active('test'))
+
+        self.gargoyle._stale_since -= self.gargoyle.stale_grace + 1
+        self.gargoyle._cleanup()
+        self.assertFalse(self.gargoyle.is_active('test'))
+        self.assertEquals(self.gargoyle.stats['lock_contended'], 1)
+        self.assertEquals(self.gargoyle.stats['reloads'], 1)
+
+    def test_reload_releases_lock(self):
+        self.change_behind_the_scenes('test', status=DISABLED)
+
+        self.assertFalse(self.gargoyle.is_active('test'))
+        self.assertEquals(self.gargoyle.stats['reloads'], 1)
+        self.assertEquals(cache.get(self.gargoyle.remote_cache_lock_key), None)
+
+    def test_cold_start_waits_for_reload(self):
+        cache.add(self.gargoyle.remote_cache_lock_key, 'other')
+        version = cache.incr(self.gargoyle.remote_cache_version_key)
+
+        # the other process publishes the switches while this one waits
+        publish = threading.Timer(0.05, set_chunked, [
+            cache, self.gargoyle.remote_cache_key, compact.dump({'test': CompactSwitch('test', DISABLED, {})}),
+        ], {'tag': version})
+        publish.start()
+        other = self.get_manager()
+        with self.assertNumQueries(0):
+            self.assertFalse(other.is_active('test'))
+        publish.join()
+        self.assertEquals(other.stats['reload_waits'], 1)
+        self.assertEquals(other.stats['lock_contended'], 0)
+
+    def test_cold_start_gives_up_waiting(self):
+        cache.add(self.gargoyle.remote_cache_lock_key, 'other')
+        cache.incr(self.gargoyle.remote_cache_version_key)
+
+        other = self.get_manager()
+        self.assertTrue(other.is_active('test'))
+        self.assertEquals(other.stats['lock_contended'], 1)
+
+
+class BrokenCache(object):
+    def __init__(self, cache):
+        self.cache = cache
+        self.broken = False
+
+    def __getattr__(self, name):
+        if self.broken:
+            raise IOError('cache is down')
+        return getattr(self.cache, name)
+
+
+class SnapshotPathTest(SwitchManagerTestMixin, TestCase):
+    def setUp(self):
+        Switch.objects.create(key='test', status=GLOBAL)
+        self.path = os.path.join(tempfile.mkdtemp(), 'switches')
+        self.manager_options = {'cache': BrokenCache(cache), 'snapshot_path': self.path}
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def test_switches_are_written(self):
+        manager = self.get_manager()
+        self.assertTrue(manager.is_active('test'))
+        switches, watermark, version = compact.read(self.path)
+        self.assertEquals(switches.keys(), ['test'])
+        self.assertEquals(version, manager._local_version)
+
+        # only when they change
+        os.utime(self.path, (0, 0))
+        manager._cleanup()
+        self.assertTrue(manager.is_active('test'))
+        self.assertEquals(os.stat(self.path).st_mtime, 0)
+
+        manager['test'].delete()
+        self.assertEquals(compact.read(self.path)[0], {})
+
+    def test_cold_start(self):
+        self.assertTrue(self.get_manager().is_active('test'))
+
+        manager = self.get_manager()
+        with self.assertNumQueries(0):
+            self.assertTrue(manager.is_active('test'))
+        self.assertEquals(manager.stats['snapshot_path_loads'], 1)
+        self.assertEquals(manager.stats['cache_hits'], 0)
+
+    def test_backend_failure(self):
+        self.assertTrue(self.get_manager().is_active('test'))
+
+        manager = self.get_manager()
+        manager.remote_cache.broken = True
+        self.assertTrue(manager.is_active('test'))
+        self.assertEquals(manager.stats['backend_errors'], 1)
+
+        # the backends are left alone for a while
+        manager._cleanup()
+        self.assertTrue(manager.is_active('test'))
+        self.assertEquals(manager.stats['backend_errors'], 1)
+
+        manager._backend_failed_at -= manager.backend_retry_interval
+        manager._cleanup()
+        self.assertTrue(manager.is_active('test'))
+        self.assertEquals(manager.stats['backend_errors'], 2)
+
+        manager.remote_cache.broken = False
+        Switch.objects.filter(key='test').update(status=DISABLED)
+        cache.incr(manager.remote_cache_version_key)
+        manager._backend_failed_at -= manager.backend_retry_interval
+        manager._cleanup()
+        self.assertFalse(manager.is_active('test'))
+
+    def test_backend_failure_without_snapshot_path(self):
+        manager = self.get_manager()
+        manager.snapshot_path = None
+        manager.remote_cache.broken = True
+        self.assertRaises(IOError, manager.is_active, 'test')
+
+
+class HeldElsewhere(object):
+    def is_held(self):
+        return False
+
+    def acquire(self):
+        return False
+
+
+class SharedSnapshotTest(SwitchManagerTestMixin, TestCase):
+    def setUp(self):
+        Switch.objects.create(key='test', status=GLOBAL)
+        self.path = os.path.join(tempfile.mkdtemp(), 'switches')
+        self.manager_options = {'snapshot_path': self.path, 'shared_snapshot': True, 'refresh_interval': 60}
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def test_shared_file(self):
+        self.assertEquals(read_file(self.path), None)
+        generation = write_file(self.path, 'foo')
+        shared_file = SharedFile(self.path)
+        self.assertEquals(shared_file.generation, generation)
+        self.assertEquals(shared_file.read(), 'foo')
+        self.assertTrue(shared_file.is_current())
+
+        new_generation = write_file(self.path, 'bar')
+        self.assertTrue(new_generation > generation)
+        self.assertFalse(shared_file.is_current())
+        # still mapped
+        self.assertEquals(shared_file.read(), 'foo')
+        self.assertEquals(read_file(self.path), 'bar')
+        shared_file.close()
+
+        with open(self.path, 'w') as fp:
+            fp.write('not shared')
+        self.assertEquals(read_file(self.path), None)
+
+    def test_host_lock(self):
+        lock_path = self.path + '.lock'
+        other = subprocess.Popen([sys.executable, '-c', (
+            'import fcntl, sys; fp = open(%r, "a"); fcntl.lockf(fp, fcntl.LOCK_EX); '
+            'sys.stdout.write("locked\\n"); sys.stdout.flush(); sys.stdin.read()' % lock_path
+        )], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            self.assertEquals(other.stdout.readline(), 'locked\n')
+            lock = HostLock(lock_path)
+            self.assertFalse(lock.acquire())
+            self.assertFalse(lock.is_held())
+        finally:
+            other.communicate()
+        self.assertTrue(lock.acquire())
+        self.assertTrue(lock.is_held())
+        lock.release()
+        self.assertFalse(lock.is_held())
+
+        lock = HostLock(os.path.join(self.path, 'missing', 'lock'))
+        self.assertFalse(lock.acquire())
+        self.assertFalse(lock.is_held())
+
+    def test_readers_do_not_load_switches(self):
+        writer = self.get_manager()
+        self.assertTrue(writer.is_active('test'))
+        self.assertTrue(writer._is_snapshot_writer())
+
+        reader = self.get_manager()
+        reader._writer_lock = HeldElsewhere()
+        del reader.remote_cache.gets[:]
+        with self.assertNumQueries(0):
+            self.assertTrue(reader.is_active('test'))
+        self.assertEquals(reader.remote_cache.gets, [])
+        self.assertEquals(reader.stats['shared_loads'], 1)
+
+        # changed by another host
+        self.change_behind_the_scenes('test', reader, status=DISABLED)
+        self.assertTrue(reader.is_active('test'))
+
+        writer.refresh()
+        self.assertFalse(writer.is_active('test'))
+        with self.assertNumQueries(0):
+            self.assertFalse(reader.is_active('test'))
+            self.assertFalse(reader.is_active('test'))
+        self.assertEquals(reader.remote_cache.gets, [])
+        self.assertEquals(reader.stats['shared_loads'], 2)
+
+    def test_requires_snapshot_path(self):
+        self.assertRaises(ValueError, SwitchManager, Switch, key='key', value='value', instances=True,
+                          shared_snapshot=True, refresh_interval=60)
+
+    def test_unwritable_lock(self):
+        manager = self.get_manager()
+        manager.snapshot_path = os.path.join(self.path, 'missing', 'switches')
+        self.assertTrue(manager.is_active('test'))
+        self.assertFalse(manager._is_snapshot_writer())
+
+    def test_requires_refresh_interval(self):
+        # otherwise readers would be left with stale switches while the writer is idle
+        self.assertRaises(ValueError, SwitchManager, Switch, key='key', value='value', instances=True,
+                          snapshot_path=self.path, shared_snapshot=True)
+
+
+class BackendTest(SwitchManagerTestMixin, TestCase):
+    def test_memory(self):
+        backend = MemoryBackend([CompactSwitch('test', GLOBAL, {})])
+        manager = self.get_manager(backend=backend)
+        with self.assertNumQueries(0):
+            self.assertTrue(manager.is_active('test'))
+            self.assertFalse(manager.is_active('inactive_by_default'))
+        self.assertEquals(backend.get('inactive_by_default').status, DISABLED)
+        self.assertEquals(manager['test'].status, GLOBAL)
+
+        backend.save(CompactSwitch('test', DISABLED, {}))
+        manager._cleanup()
+        self.assertFalse(manager.is_active('test'))
+
+        backend.delete('test')
+        manager._cleanup()
+        self.assertFalse('test' in manager)
+
+    def test_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'switches.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'w') as fp:
+            json.dump({
+                'test': {'status': 'global'},
+                'selective': {'status': 'selective', 'value': {'auth.user': {'username': [['i', 'bob']]}}},
+            }, fp)
+
+        manager = self.get_manager(backend=FileBackend(path))
+        with self.assertNumQueries(0):
+            self.assertTrue(manager.is_active('test'))
+            self.assertTrue(manager.is_active('selective', User(username='bob')))
+            self.assertFalse(manager.is_active('selective', User(username='joe')))
+
+        with open(path, 'w') as fp:
+            json.dump({'test': {'status': DISABLED}}, fp)
+        manager._cleanup()
+        self.assertFalse(manager.is_active('test'))
+        self.assertFalse('selective' in manager)
+
+        with open(path, 'w') as fp:
+            json.dump({'test': {'status': 'unknown'}}, fp)
+        self.assertRaises(ValueError, FileBackend(path).load)
+
+    def test_yaml_file(self):
+        if backends.yaml is None:
+            self.assertRaises(ImproperlyConfigured, FileBackend, 'switches.yaml')
+            return
+        path = os.path.join(tempfile.mkdtemp(), 'switches.yaml')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write(
+                'test:\n'
+                '  status: global\n'
+                'selective:\n'
+                '  status: selective\n'
+                '  value:\n'
+                '    auth.user:\n'
+                '      username: [[i, bob]]\n'
+            )
+
+        manager = self.get_manager(backend=FileBackend(path))
+        with self.assertNumQueries(0):
+            self.assertTrue(manager.is_active('test'))
+            self.assertTrue(manager.is_active('selective', User(username='bob')))
+            self.assertFalse(manager.is_active('selective', User(username='joe')))
+
+    def test_cache(self):
+        backend = CacheBackend(RecordingCache(cache), key_prefix='test')
+        backend.save_many([CompactSwitch('test', GLOBAL, {}), CompactSwitch('other', DISABLED, {})])
+
+        # a single switch is read on its own
+        del backend.cache.gets[:]
+        self.assertEquals(backend.get('test').status, GLOBAL)
+        self.assertEquals(backend.cache.gets, [backend.get_key('test')])
+
+        manager = self.get_manager(backend=backend)
+        with self.assertNumQueries(0):
+            self.assertTrue(manager.is_active('test'))
+            self.assertFalse(manager.is_active('other'))
+
+        backend.save(CompactSwitch('other', GLOBAL, {}))
+        manager._cleanup()
+        self.assertTrue(manager.is_active('other'))
+
+        backend.delete('test')
+        manager._cleanup()
+        self.assertFalse('test' in manager)
+        self.assertEquals(backend.get('test'), None)
+
+    def test_cache_concurrent_saves(self):
+        backend = CacheBackend(SlowCache(cache), key_prefix='test')
+        backend.save_many([])
+        threads = [threading.Thread(target=backend.save, args=(CompactSwitch('switch%d' % i, GLOBAL, {}),))
+                   for i in xrange(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(sorted(backend.load()[0]), sorted('switch%d' % i for i in xrange(10)))
+        self.assertEquals(cache.get(backend.lock_key), None)
+
+    def test_cache_lock_taken_over(self):
+        backend = CacheBackend(cache, key_prefix='test')
+        backend.save_many([])
+
+        def update(keys):
+            # held too long, and taken by another writer meanwhile
+            cache.set(backend.lock_key, 'other')
+            keys.add('test')
+
+        backend._update_keys(update)
+        self.assertEquals(cache.get(backend.lock_key), 'other')
+        cache.delete(backend.lock_key)
+
+    def test_cache_evicted_keys(self):
+        backend = CacheBackend(cache, key_prefix='test')
+        backend.save_many([CompactSwitch('test', GLOBAL, {})])
+        manager = self.get_manager(backend=backend)
+        self.assertTrue(manager.is_active('test'))
+
+        cache.delete(backend.keys_key)
+        self.assertRaises(RuntimeError, backend.load)
+        self.assertRaises(RuntimeError, backend.save, CompactSwitch('other', GLOBAL, {}))
+
+        # the switches already loaded are kept
+        cache.incr(backend.version_key)
+        manager._cleanup()
+        self.assertTrue(manager.is_active('test'))
+        self.assertEquals(manager.stats['backend_errors'], 1)
+
+        backend.save_many([CompactSwitch('test', GLOBAL, {}), CompactSwitch('other', GLOBAL, {})])
+        self.assertEquals(sorted(backend.load()[0]), ['other', 'test'])
+
+    def test_get_backend(self):
+        backend = get_backend('gargoyle.backends.CacheBackend', key_prefix='test')
+        self.assertTrue(isinstance(backend, CacheBackend))
+        self.assertEquals(backend.key_prefix, 'test')
+        self.assertRaises(ImproperlyConfigured, get_backend, 'gargoyle.backends.UnknownBackend')
+        self.assertRaises(ImproperlyConfigured, get_backend, 'gargoyle.unknown.CacheBackend')
+
+
+class IncrementalRefreshTest(SwitchManagerTestMixin, TestCase):
+    def setUp(self):
+        self.gargoyle = self.get_manager(incremental=True)
+        Switch.objects.create(key='a', status=GLOBAL)
+        Switch.objects.create(key='a:child', status=INHERIT)
+        Switch.objects.create(key='b', status=GLOBAL)
+        Switch.objects.create(key='c', status=DISABLED)
+        self.assertTrue(self.gargoyle.is_active('a'))
+
+    def test_only_changed_switches_are_loaded(self):
+        plans = self.gargoyle._get_plans()
+
+        self.change_behind_the_scenes('a', status=DISABLED)
+        with self.assertNumQueries(2):
+            self.assertFalse(self.gargoyle.is_active('a'))
+        self.assertFalse(self.gargoyle.is_active('a:child'))
+        self.assertTrue(self.gargoyle.is_active('b'))
+
+        new_plans = self.gargoyle._get_plans()
+        self.assertFalse(new_plans['a'] is plans['a'])
+        self.assertFalse(new_plans['a:child'] is plans['a:child'])
+        self.assertTrue(new_plans['b'] is plans['b'])
+        self.assertTrue(new_plans['c'] is plans['c'])
+        # the previous snapshot is untouched
+        self.assertTrue(plans['a:child'].constant)
+
+    def test_deleted_switches(self):
+        Switch.objects.filter(key='b').delete()
+        self.assertTrue(DeletedSwitch.objects.filter(key='b').exists())
+        self.assertFalse('b' in self.gargoyle._get_plans())
+
+        # deleted by another process
+        DeletedSwitch.objects.create(key='a')
+        connection.cursor().execute('DELETE FROM gargoyle_switch WHERE key = %s', ['a'])
+        cache.incr(self.gargoyle.remote_cache_version_key)
+        self.gargoyle._cleanup()
+        with self.assertNumQueries(2):
+            self.assertFalse('a' in self.gargoyle._get_plans())
+        self.assertFalse(self.gargoyle._get_plan('a:child').dynamic)
+        self.assertFalse(self.gargoyle.is_active('a:child'))
+
+        # and created again
+        Switch.objects.bulk_create([Switch(key='a', status=GLOBAL)])
+        self.change_behind_the_scenes('a')
+        self.assertTrue(self.gargoyle.is_active('a:child'))
+
+    def test_old_tombstones_are_pruned(self):
+        DeletedSwitch.objects.create(key='old', date_deleted=datetime.datetime.now() - datetime.timedelta(days=8))
+        DeletedSwitch.objects.create(key='recent', date_deleted=datetime.datetime.now() - datetime.timedelta(days=6))
+        Switch.objects.filter(key='b').delete()
+        self.assertEquals(sorted(DeletedSwitch.objects.values_list('key', flat=True)), ['b', 'recent'])
+
+    def test_full_reload_when_tombstones_may_be_pruned(self):
+        # nothing was modified since the oldest tombstones
+        self.gargoyle._watermark -= self.gargoyle.tombstone_retention
+        reloads = self.gargoyle.stats['reloads']
+        self.change_behind_the_scenes('a', status=DISABLED)
+        self.assertFalse(self.gargoyle.is_active('a'))
+        self.assertEquals(self.gargoyle.stats['reloads'], reloads + 1)
+
+        # then incrementally again
+        self.change_behind_the_scenes('a', status=GLOBAL)
+        self.assertTrue(self.gargoyle.is_active('a'))
+        self.assertEquals(self.gargoyle.stats['reloads'], reloads + 1)
+
+    def test_added_switches(self):
+        Switch.objects.bulk_create([Switch(key='d', status=GLOBAL)])
+        self.change_behind_the_scenes('d')
+        self.assertTrue(self.gargoyle.is_active('d'))
+
+    def test_matches_full_reload(self):
+        self.change_behind_the_scenes('a', status=SELECTIVE, value={'auth.user': {'username': [['i', 'bob']]}})
+        self.change_behind_the_scenes('c', status=GLOBAL)
+
+        other = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True)
+        other.register(UserConditionSet(User))
+        for key in ('a', 'a:child', 'b', 'c'):
+            for user in (User(username='bob'), User(username='joe')):
+                self.assertEquals(self.gargoyle.is_active(key, user), other.is_active(key, user), key)
+
+
+class RefresherTest(SwitchManagerTestMixin, TestCase):
+    def setUp(self):
+        self.gargoyle = self.get_manager(refresh_interval=60, max_staleness=120)
+        Switch.objects.create(key='test', status=GLOBAL)
+
+    def wait_for_refresh(self, refresher):
+        for i in xrange(100):
+            if refresher.last_refreshed is not None:
+                return
+            time.sleep(0.01)
+        self.fail('switches were never refreshed')
+
+    def test_checks_do_not_load_switches(self):
+        self.assertTrue(self.gargoyle.is_active('test'))
+        refresher = self.gargoyle._refresher
+        self.assertTrue(refresher.is_alive())
+        self.assertTrue(refresher.daemon)
+        self.wait_for_refresh(refresher)
+
+        def populate(*args, **kwargs):
+            raise AssertionError('should not be loaded')
+        self.gargoyle._populate = populate
+        try:
+            self.assertTrue(self.gargoyle.is_active('test'))
+            self.assertEquals(self.gargoyle.is_active_many(['test']), {'test': True})
+        finally:
+            del self.gargoyle._populate
+
+    def test_refresh(self):
+        refresher = self.gargoyle.start_refresher()
+        self.assertTrue(self.gargoyle.start_refresher() is refresher)
+        self.wait_for_refresh(refresher)
+        self.assertTrue(self.gargoyle.is_active('test'))
+
+        self.change_behind_the_scenes('test', status=DISABLED)
+        self.assertTrue(self.gargoyle.is_active('test'))
+
+        self.assertTrue(refresher.refresh())
+        self.assertFalse(self.gargoyle.is_active('test'))
+
+    def test_own_changes_are_seen(self):
+        self.wait_for_refresh(self.gargoyle.start_refresher())
+        switch = self.gargoyle['test']
+        switch.status = DISABLED
+        switch.save()
+        self.assertFalse(self.gargoyle.is_active('test'))
+
+    def test_max_staleness(self):
+        refresher = self.gargoyle.start_refresher()
+        self.wait_for_refresh(refresher)
+
+        self.change_behind_the_scenes('test', status=DISABLED)
+        self.assertTrue(self.gargoyle.is_active('test'))
+
+        refresher.last_refreshed -= 121
+        self.assertFalse(refresher.is_fresh())
+        self.assertFalse(self.gargoyle.is_active('test'))
+
+    def test_failures_are_logged(self):
+        refresher = self.gargoyle.start_refresher()
+        self.wait_for_refresh(refresher)
+        last_refreshed = refresher.last_refreshed
+
+        def refresh():
+            raise ValueError
+        self.gargoyle.refresh = refresh
+
+        self.assertFalse(refresher.refresh())
+        self.assertEquals(refresher.last_refreshed, last_refreshed)
+
+    def test_connections_are_closed(self):
+        closed = []
+
+        def close_old_connections():
+            closed.append(threading.current_thread().name)
+        self.addCleanup(setattr, refresher_module, 'close_old_connections', refresher_module.close_old_connections)
+        refresher_module.close_old_connections = close_old_connections
+
+        refresher = self.gargoyle.start_refresher()
+        self.wait_for_refresh(refresher)
+        refresher.stop()
+        refresher.join()
+        # before and after refreshing
+        self.assertEquals(closed, ['gargoyle-refresher', 'gargoyle-refresher'])
+
+        # but not when refreshing from a request
+        self.assertTrue(refresher.refresh())
+        self.assertEquals(len(closed), 2)
+
+    def test_dead_refresher_is_replaced(self):
+        refresher = self.gargoyle.start_refresher()
+        self.wait_for_refresh(refresher)
+        refresher.stop()
+        refresher.join()
+        refresher.last_refreshed = None
+
+        self.assertTrue(self.gargoyle.is_active('test'))
+        self.assertFalse(self.gargoyle._refresher is refresher)
+
+
+class FieldTest(TestCase):
+    def assertMatchesUncompiled(self, field, conditions, values):
+        compiled = field.compile(conditions)
+        uncompiled = ConditionMatcher(field, conditions)
+        for value in values:
+            self.assertEquals(compiled(value), uncompiled(value), (conditions, value))
+
+    def test_ip_network(self):
+        field = IPNetwork()
+        self.assertEquals(field.clean('10.0.0.0/8'), '10.0.0.0/8')
+        self.assertRaises(ValidationError, field.clean, '10.0.0.0/40')
+        self.assertTrue(field.is_active('10.0.0.0/8', parse_ip('10.0.0.1')))
+        self.assertFalse(field.is_active('10.0.0.0/8', None))
+
+        values = [parse_ip(ip) for ip in ('10.0.0.1', '10.1.0.1', '127.0.0.1', '::1', 'fe80::1')] + [None]
+        for conditions in (
+            [['i', '10.0.0.0/8']],
+            [['i', '10.0.0.0/8'], ['i', '::1']],
+            [['e', '10.1.0.0/16']],
+            [['i', '10.0.0.0/8'], ['e', '10.1.0.0/16']],
+            [['i', 'fe80::/10']],
+        ):
+            self.assertMatchesUncompiled(field, conditions, values)
+
+    def test_percent(self):
+        field = Percent()
+        matcher = field.compile([['i', '0-50'], ['i', '40-60']])
+        self.assertEquals(len(matcher.buckets), 100)
+        self.assertTrue(matcher(5))
+        self.assertTrue(matcher(160))
+        self.assertEquals(matcher(61), None)
+
+        for conditions in (
+            [['i', '0-50']],
+            [['i', '0-50'], ['i', '40-60']],
+            [['e', '10-20']],
+            [['i', '0-50'], ['e', '10-20']],
+            [['i', '0-100'], ['e', '99-100']],
+        ):
+            self.assertMatchesUncompiled(field, conditions, range(-5, 205))
+
+    def test_range(self):
+        field = Range()
+        self.assertTrue(field.is_active('10-20', 15))
+        self.assertFalse(field.is_active('10-20', 21))
+        for conditions in (
+            [['i', '10-20']],
+            [['i', '10-20'], ['i', '100-200']],
+            [['e', '10-20']],
+            [['i', '0-50'], ['e', '10-20']],
+        ):
+            self.assertMatchesUncompiled(field, conditions, range(-5, 205))
+
+    def test_invalid_ranges_fail_when_checked(self):
+        field = Percent()
+        matcher = field.compile([['i', 'foo']])
+        self.assertRaises(ValueError, matcher, 5)
+
+    def test_dates(self):
+        values = [
+            datetime.date(2011, 6, 30),
+            datetime.date(2011, 7, 1),
+            datetime.datetime(2011, 7, 1, 12, 30),
+            datetime.date(2011, 7, 2),
+            datetime.datetime(2012, 1, 1),
+        ]
+        for field in (BeforeDate(), OnOrAfterDate()):
+            matcher = field.compile([['i', '2011-07-01']])
+            self.assertEquals(matcher.includes, [datetime.date(2011, 7, 1)])
+            for conditions in (
+                [['i', '2011-07-01']],
+                [['i', '2011-07-01'], ['i', '2011-12-31']],
+                [['e', '2011-07-01']],
+                [['i', '2011-07-02'], ['e', '2011-07-01']],
+            ):
+                self.assertMatchesUncompiled(field, conditions, values)
+
+        matcher = OnOrAfterDate().compile([['i', 'not a date']])
+        self.assertRaises(ValueError, matcher, datetime.date(2011, 7, 1))
+
+    def test_strings(self):
+        field = String()
+        names = ['user%d' % i for i in xrange(1000)]
+        matcher = field.compile([['i', name] for name in names])
+        self.assertEquals(matcher.includes, frozenset(names))
+        self.assertTrue(matcher('user999'))
+        self.assertTrue(matcher(u'user999'))
+        self.assertEquals(matcher('bob'), None)
+
+        for conditions in (
+            [['i', 'bob']],
+            [['i', 'bob'], ['i', 'joe']],
+            [['e', 'bob']],
+            [['i', 'joe'], ['e', 'bob']],
+            [['i', 'bob'], ['e', 'bob']],
+        ):
+            self.assertMatchesUncompiled(field, conditions, ['bob', 'joe', 'john', '', None, ['bob']])
+
+    def test_strings_matching_on_something_else(self):
+        class CaseInsensitiveString(String):
+            def is_active(self, condition, value):
+                return condition.lower() == value.lower()
+
+        matcher = CaseInsensitiveString().compile([['i', 'Bob']])
+        self.assertTrue(matcher('bob'))
+
+    def test_percent_display(self):
+        field = Percent(label='Percent')
+        self.assertEquals(field.display('10-60'), 'Percent: 50% (10-60)')
+
+
 class ConstantTest(TestCase):
     def setUp(self):
         self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True)
@@ -1062,6 +2685,56 @@ class HostConditionSetTest(TestCase):
 
         self.assertTrue(self.gargoyle.is_active('test'))
 
+    def test_checked_when_compiled(self):
+        lookups = []
+
+        class CountingConditionSet(EnvironmentConditionSet):
+            name = String()
+
+            def get_field_value(self, instance, field_name):
+                lookups.append(field_name)
+                return 'foo'
+
+        self.gargoyle.register(CountingConditionSet())
+        self.gargoyle.register(UserConditionSet(User))
+
+        Switch.objects.create(key='foo', status=SELECTIVE)
+        self.gargoyle['foo'].add_condition(
+            condition_set='tests.tests.CountingConditionSet',
+            field_name='name',
+            condition='foo',
+        )
+        Switch.objects.create(key='bar', status=SELECTIVE)
+        self.gargoyle['bar'].add_condition(
+            condition_set='tests.tests.CountingConditionSet',
+            field_name='name',
+            condition='bar',
+        )
+        Switch.objects.create(key='foo:bob', status=SELECTIVE)
+        self.gargoyle['foo:bob'].add_condition(
+            condition_set='tests.tests.CountingConditionSet',
+            field_name='name',
+            condition='foo',
+        )
+        self.gargoyle['foo:bob'].add_condition(
+            condition_set='gargoyle.builtins.UserConditionSet(auth.user)',
+            field_name='username',
+            condition='bob',
+            exclude=True,
+        )
+
+        del lookups[:]
+        for i in xrange(3):
+            self.assertTrue(self.gargoyle.is_active('foo'))
+            self.assertFalse(self.gargoyle.is_active('bar'))
+            self.assertTrue(self.gargoyle.is_active('foo:bob', User(username='alice')))
+            self.assertFalse(self.gargoyle.is_active('foo:bob', User(username='bob')))
+        self.assertEquals(len(lookups), 3)
+
+        self.assertFalse(self.gargoyle._get_plan('foo').dynamic)
+        self.assertFalse(self.gargoyle._get_plan('bar').dynamic)
+        self.assertTrue(self.gargoyle._get_plan('foo:bob').dynamic)
+
 
 class SwitchContextManagerTest(TestCase):
     def setUp(self):
@@ -1201,3 +2874,34 @@ class HelpersTestCase(TestCase):
             del sys.modules['json']
         sys.modules['gargoyle.helpers'] = self.old_gargoyle_helpers
         gargoyle.helpers = self.old_gargoyle_helpers
+
+
+class WarmTestCase(TestCase):
+
+    def setUp(self):
+        self.gargoyle = SwitchManager(Switch, key='key', value='value', instances=True, auto_create=True,
+                                      refresh_interval=60)
+        Switch.objects.create(key='test', status=GLOBAL)
+
+    def tearDown(self):
+        self.gargoyle.stop_refresher()
+
+    def test_warm(self):
+        snapshot = gargoyle.warm(self.gargoyle)
+        self.assertTrue('test' in snapshot.plans)
+        self.assertTrue(self.gargoyle._snapshot is snapshot)
+        # nothing which wouldn't survive forking
+        self.assertEquals(self.gargoyle._refresher, None)
+        self.assertTrue(gargoyle.gargoyle.get_condition_set_by_id('gargoyle.builtins.IPAddressConditionSet'))
+
+    def test_command(self):
+        out = StringIO()
+        call_command('warm_switches', stdout=out)
+        self.assertTrue(out.getvalue().startswith('Loaded'))
+
+    def test_memory_usage(self):
+        usage = get_memory_usage()
+        if usage is None:
+            return
+        rss, private = usage
+        self.assertTrue(0 < private <= rss)